@@ -1,5 +1,9 @@
+const crypto = require("crypto");
 const { defineConfig } = require("cypress");
 
+// must match the app's STRIPE_WEBHOOK_SECRET, which defaults to this in the test environment
+const stripeWebhookSecret = process.env.STRIPE_WEBHOOK_SECRET || "whsec_test";
+
 module.exports = defineConfig({
   video: true,
   defaultCommandTimeout: 40000,
@@ -8,6 +12,17 @@ module.exports = defineConfig({
     setupNodeEvents(on, config) {
       const { plugin: cypressGrepPlugin } = require("@cypress/grep/plugin");
       cypressGrepPlugin(config);
+      on("task", {
+        // signs a webhook payload the same way Stripe does, see https://docs.stripe.com/webhooks#verify-manually
+        signStripeWebhookPayload({ payload, secret = stripeWebhookSecret }) {
+          const timestamp = Math.floor(Date.now() / 1000);
+          const signature = crypto
+            .createHmac("sha256", secret)
+            .update(`${timestamp}.${payload}`)
+            .digest("hex");
+          return `t=${timestamp},v1=${signature}`;
+        },
+      });
       return config;
     },
   },
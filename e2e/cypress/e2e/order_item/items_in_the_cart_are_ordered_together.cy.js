@@ -0,0 +1,93 @@
+import { getDataTestIdElement } from "../../helpers";
+import { clickTestItemButton, getUserOrdersApi } from "../../steps/orders";
+import { getPaymentApi } from "../../steps/payments";
+import {
+  assertStripeLineItemsMatchExpected,
+  triggerSuccessfulStripePayment,
+} from "../../steps/stripe";
+import {
+  createGuestUserApi,
+  generateUsername,
+  logUserOn,
+} from "../../steps/users";
+
+function addTestItemToCart(quantity) {
+  clickTestItemButton();
+  getDataTestIdElement("item_quantity_input").clear().type(quantity);
+  getDataTestIdElement("item_add_to_cart").click();
+}
+
+describe(
+  "When a user adds items to the cart",
+  { testIsolation: false, tags: ["@payments"] },
+  () => {
+    it("the cart can be registered to the tab in one go", () => {
+      const username = generateUsername();
+      createGuestUserApi(username);
+      cy.visit("/");
+      logUserOn(username);
+      addTestItemToCart(2);
+      addTestItemToCart(1);
+      getDataTestIdElement("cart_total").should("have.text", "Total: €3.00");
+      getDataTestIdElement("cart_register").click();
+      cy.contains("Cart registered succesfully. Thank you!");
+      getDataTestIdElement("cart_table").should("not.exist");
+      getUserOrdersApi(username).then((userOrdersResponse) => {
+        expect(userOrdersResponse.body.orders).to.have.lengthOf(1);
+        expect(userOrdersResponse.body.orders[0].quantity).to.eq(3);
+      });
+    });
+
+    it("the cart can be paid for with a single Stripe checkout", () => {
+      const username = generateUsername();
+      createGuestUserApi(username);
+      cy.visit("/");
+      logUserOn(username);
+      addTestItemToCart(3);
+      getDataTestIdElement("cart_pay_now").click();
+      getDataTestIdElement("stripe-subtotal").should(
+        "have.text",
+        "Subtotal: €3.00",
+      );
+      getDataTestIdElement("stripe_qr_code_image");
+      triggerSuccessfulStripePayment();
+      getDataTestIdElement("stripe_payment_successful_text").should(
+        "be.visible",
+      );
+      getUserOrdersApi(username).then((userOrdersResponse) => {
+        expect(userOrdersResponse.body.orders).to.have.lengthOf(1);
+        const order = userOrdersResponse.body.orders[0];
+        getPaymentApi(order.order_id).then((paymentResponse) => {
+          expect(paymentResponse.body.payment.order_id).to.eq(order.order_id);
+        });
+      });
+      getDataTestIdElement("stripe_dialog_close").click();
+      getDataTestIdElement("cart_table").should("not.exist");
+    });
+
+    it("will record one line item per product for Stripe", () => {
+      assertStripeLineItemsMatchExpected([
+        {
+          price_data: {
+            currency: "eur",
+            product_data: {
+              name: "TEST ITEM",
+            },
+            unit_amount: 100,
+          },
+          quantity: 3,
+        },
+        {
+          price_data: {
+            currency: "eur",
+            product_data: {
+              name: "System Provider Handling Fee",
+            },
+            unit_amount: 10,
+          },
+          quantity: 1,
+        },
+      ]);
+    });
+  },
+);
@@ -0,0 +1,62 @@
+import { getDataTestIdElement } from "../../helpers";
+import { clickTestItemButton, getUserOrdersApi } from "../../steps/orders";
+import { sendStripeWebhookEvent } from "../../steps/stripe";
+import {
+  createGuestUserApi,
+  generateUsername,
+  logUserOn,
+} from "../../steps/users";
+
+function openItemPaymentDialog() {
+  const username = generateUsername();
+  createGuestUserApi(username);
+  cy.visit("/");
+  logUserOn(username);
+  clickTestItemButton();
+  getDataTestIdElement("item_pay_now").click();
+  getDataTestIdElement("stripe_qr_code_image");
+  return username;
+}
+
+describe(
+  "When Stripe sends a webhook for an item payment",
+  { tags: ["@payments"] },
+  () => {
+    it("a signed completed checkout session registers the item", () => {
+      const username = openItemPaymentDialog();
+      sendStripeWebhookEvent("checkout.session.completed").then((response) => {
+        expect(response.status).to.eq(200);
+      });
+      getDataTestIdElement("stripe_payment_successful_text").should(
+        "be.visible",
+      );
+      getUserOrdersApi(username).then((response) => {
+        expect(response.body.orders).to.have.lengthOf(1);
+        expect(response.body.orders[0].item).to.eq("TEST ITEM");
+      });
+    });
+
+    it("a webhook with an invalid signature is rejected", () => {
+      const username = openItemPaymentDialog();
+      sendStripeWebhookEvent("checkout.session.completed", {
+        secret: "whsec_wrong",
+      }).then((response) => {
+        expect(response.status).to.eq(400);
+      });
+      getDataTestIdElement("stripe_payment_successful_text").should(
+        "not.exist",
+      );
+      getUserOrdersApi(username).then((response) => {
+        expect(response.body.orders).to.have.lengthOf(0);
+      });
+    });
+
+    it("a signed expired checkout session shows the timeout message", () => {
+      openItemPaymentDialog();
+      sendStripeWebhookEvent("checkout.session.expired", {
+        paymentStatus: "unpaid",
+      });
+      cy.contains("This transaction has timed out, please try again.");
+    });
+  },
+);
@@ -23,6 +23,51 @@ export function triggerSuccessfulStripePayment() {
   });
 }
 
+export function sendStripeWebhookEvent(
+  type,
+  { secret, paymentStatus = "paid" } = {},
+) {
+  return cy
+    .getAllSessionStorage()
+    .then((result) =>
+      cy.request({
+        url: "http://app:8000/api/test/stripe/session",
+        qs: { token: result["http://app:3000"].token },
+      }),
+    )
+    .then((sessionResponse) => {
+      const payload = JSON.stringify({
+        id: `evt_${sessionResponse.body.stripe_session_id}`,
+        object: "event",
+        type,
+        data: {
+          object: {
+            id: sessionResponse.body.stripe_session_id,
+            object: "checkout.session",
+            status:
+              type === "checkout.session.expired" ? "expired" : "complete",
+            payment_status: paymentStatus,
+            metadata: { ob_payment_id: sessionResponse.body.ob_payment_id },
+          },
+        },
+      });
+      return cy
+        .task("signStripeWebhookPayload", { payload, secret })
+        .then((signature) =>
+          cy.request({
+            method: "POST",
+            url: "http://app:8000/api/stripe/webhook",
+            headers: {
+              "Content-Type": "application/json",
+              "Stripe-Signature": signature,
+            },
+            body: payload,
+            failOnStatusCode: false,
+          }),
+        );
+    });
+}
+
 function sortLineItemsByItemName(lineItems) {
   return lineItems.sort((a, b) =>
     a.price_data.product_data.name.localeCompare(
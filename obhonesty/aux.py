@@ -1,8 +1,11 @@
-import socket
+import hashlib
+import json
 from datetime import datetime
+from functools import lru_cache
+import segno
 from reflex.vars import NumberVar, var_operation, var_operation_return
 from zoneinfo import ZoneInfo
-from obhonesty.constants import SYSTEM_PROVIDER_HANDLING_FEE
+from obhonesty.constants import DATETIME_FORMAT, SYSTEM_PROVIDER_HANDLING_FEE
 from uuid import uuid4
 
 
@@ -15,16 +18,14 @@ def two_decimal_points(value: NumberVar):
     )
 
 
-def generate_uuid():
-    return str(uuid4())
+@lru_cache(maxsize=64)
+def generate_qr_code_data_uri(data: str) -> str:
+    """Renders the QR code as an inline SVG, so the payment dialog does not wait on a QR code service"""
+    return segno.make(data, error="m").svg_data_uri(border=2)
 
 
-def check_internet_connection():
-    try:
-        socket.create_connection(("www.google.com", 443), timeout=3)
-    except OSError:
-        print(f"No internet connection - {get_madrid_datetime_now()}", flush=True)
-        raise
+def generate_uuid():
+    return str(uuid4())
 
 
 def get_model_string_type_columns(model):
@@ -48,6 +49,10 @@ def sanitise_record_strings(string_type_columns, record):
     return record
 
 
+def get_rows_checksum(rows) -> str:
+    return hashlib.sha256(json.dumps(rows, default=str).encode()).hexdigest()
+
+
 def generate_receiver_from_names(first_name, last_name):
     return f"{first_name.upper().strip()} {last_name.upper().strip()}"
 
@@ -60,6 +65,15 @@ def get_todays_date_as_string():
     return get_madrid_datetime_now().date().strftime("%d/%m/%Y")
 
 
+def get_order_time_as_datetime(order_time: str | int | float):
+    """Returns None if the order's time is not in the sheet's datetime format, eg. if it was typed in by hand"""
+    try:
+        # numericise_all turns a hand-typed number into an int, so the value is read as a string
+        return datetime.strptime(str(order_time), DATETIME_FORMAT)
+    except ValueError:
+        return None
+
+
 def generate_line_item(name: str, unit_amount: int, quantity: int):
     return {
         "price_data": {
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import uuid
+from typing import Optional
+import redis.asyncio as redis
+from obhonesty.aux import get_madrid_datetime_now
+from obhonesty.models import Admin, Item, Meal, User
+from obhonesty.shared_cache import shared_table_cache
+
+# the slices of the state that are reloaded when their table changes
+CHANGE_TOPICS = {User: "users", Item: "items", Admin: "admin", Meal: "meals"}
+# the column that identifies a changed row, for the topics whose pages apply their changes row by row
+CHANGE_TOPIC_KEY_COLUMNS = {Meal: "meal_id"}
+CHANGE_BUS_REDIS_CHANNEL = "obhonesty:changes"
+
+
+def get_changed_row_keys(rows) -> dict[str, set[str]]:
+    changed_row_keys: dict[str, set[str]] = {}
+    for row in rows:
+        key_column = CHANGE_TOPIC_KEY_COLUMNS.get(type(row))
+        if key_column is not None:
+            changed_row_keys.setdefault(CHANGE_TOPICS[type(row)], set()).add(
+                getattr(row, key_column)
+            )
+    return changed_row_keys
+
+
+class ChangeSubscription:
+    def __init__(self, topics: set[str]):
+        self.topics = topics
+        # the changed row keys of each topic, or None when any of its rows may have changed
+        self.changes: dict[str, Optional[set[str]]] = {}
+        self.has_changes = asyncio.Event()
+
+    def notify(self, changes: dict[str, Optional[set[str]]]):
+        for topic, row_keys in changes.items():
+            if topic not in self.topics:
+                continue
+            if row_keys is None or (
+                topic in self.changes and self.changes[topic] is None
+            ):
+                self.changes[topic] = None
+            else:
+                self.changes.setdefault(topic, set()).update(row_keys)
+            self.has_changes.set()
+
+    async def wait(self, timeout: float) -> dict[str, Optional[set[str]]]:
+        """Returns the changes since the last call, or an empty dict if nothing changes within the timeout"""
+        try:
+            await asyncio.wait_for(self.has_changes.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.has_changes.clear()
+        changes = self.changes
+        self.changes = {}
+        return changes
+
+
+class ChangeBus:
+    """Tells the open pages which tables have changed, from the local commits and the sync engine's writes, so they reload only when something changed.
+    When REDIS_URL is set the changes are also published to the other workers, which drop them from their shared cache and pass them on to their own pages.
+    """
+
+    def __init__(self, redis_url: Optional[str]):
+        self.redis_url = redis_url
+        self.origin_id = str(uuid.uuid4())
+        self.subscriptions: set[ChangeSubscription] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.redis_client: Optional[redis.Redis] = None
+
+    def subscribe(self, topics: set[str]) -> ChangeSubscription:
+        self.loop = asyncio.get_running_loop()
+        subscription = ChangeSubscription(topics)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: ChangeSubscription):
+        self.subscriptions.discard(subscription)
+
+    def notify_subscriptions(self, changes: dict[str, Optional[set[str]]]):
+        for subscription in list(self.subscriptions):
+            subscription.notify(changes)
+
+    def publish_tables(
+        self, changed_tables: set[type], changed_row_keys: dict[str, set[str]]
+    ):
+        """Can be called from any thread, eg. after a commit in the sync engine's executor.
+        A topic without row keys, eg. from a bulk update, is published as if any of its rows may have changed.
+        """
+        changes = {
+            CHANGE_TOPICS[table]: changed_row_keys.get(CHANGE_TOPICS[table])
+            for table in changed_tables
+            if table in CHANGE_TOPICS
+        }
+        if not len(changes) or self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.publish, changes)
+        except RuntimeError:
+            # the event loop has closed, so there are no pages left to notify
+            pass
+
+    def publish(self, changes: dict[str, Optional[set[str]]]):
+        self.notify_subscriptions(changes)
+        if self.redis_client is not None:
+            self.loop.create_task(self.publish_to_redis(changes))
+
+    async def publish_to_redis(self, changes: dict[str, Optional[set[str]]]):
+        try:
+            await self.redis_client.publish(
+                CHANGE_BUS_REDIS_CHANNEL,
+                json.dumps(
+                    {
+                        "origin_id": self.origin_id,
+                        "changes": {
+                            topic: sorted(row_keys) if row_keys is not None else None
+                            for topic, row_keys in changes.items()
+                        },
+                    }
+                ),
+            )
+        except Exception as e:
+            print(f"Change bus publish error: {e}", flush=True)
+
+    def receive_from_redis(self, data: bytes | str):
+        message = json.loads(data)
+        if message["origin_id"] == self.origin_id:
+            return
+        changes = {
+            topic: set(row_keys) if row_keys is not None else None
+            for topic, row_keys in message["changes"].items()
+        }
+        shared_table_cache.invalidate(
+            {table for table, topic in CHANGE_TOPICS.items() if topic in changes}
+        )
+        self.notify_subscriptions(changes)
+
+    async def listen_to_redis(self):
+        while True:
+            try:
+                async with self.redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(CHANGE_BUS_REDIS_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.receive_from_redis(message["data"])
+            except Exception as e:
+                print(
+                    f"Change bus Redis error: {e} - {get_madrid_datetime_now()}",
+                    flush=True,
+                )
+            await asyncio.sleep(5)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        if self.redis_url is None:
+            return
+        self.redis_client = redis.from_url(self.redis_url)
+        await self.listen_to_redis()
+
+
+change_bus = ChangeBus(os.getenv("REDIS_URL") or None)
@@ -0,0 +1,129 @@
+import threading
+import time
+from typing import Awaitable, Callable
+from google.auth.exceptions import TransportError
+import requests
+import stripe
+from obhonesty.aux import get_madrid_datetime_now
+
+
+class ConnectivityCircuitOpenError(Exception):
+    pass
+
+
+# errors that mean the request could not reach the server, rather than the server rejecting it
+CONNECTIVITY_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    TransportError,
+    stripe.APIConnectionError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_connectivity_error(error: Exception) -> bool:
+    return isinstance(error, (ConnectivityCircuitOpenError, *CONNECTIVITY_ERRORS))
+
+
+class ConnectivityCircuitBreaker:
+    """Tracks whether the internet is reachable from the outcomes of the Google Sheets and Stripe requests.
+    After a few connection failures in a row the circuit opens, and requests fail fast instead of each waiting out a timeout.
+    Once open_seconds have passed a single trial request is let through, which closes the circuit if it succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 3, open_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failure_count = 0
+        self.opened_timestamp = 0.0
+        self.is_trial_in_progress = False
+        self.lock = threading.Lock()
+
+    def set_state(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        print(
+            f"Internet connection circuit is {state.replace('_', '-')} - {get_madrid_datetime_now()}",
+            flush=True,
+        )
+
+    def is_open(self) -> bool:
+        return self.state == "open"
+
+    def before_request(self):
+        with self.lock:
+            if self.state == "closed":
+                return
+            if (
+                self.state == "open"
+                and time.monotonic() - self.opened_timestamp >= self.open_seconds
+            ):
+                self.set_state("half_open")
+            if self.state == "half_open" and not self.is_trial_in_progress:
+                self.is_trial_in_progress = True
+                return
+            raise ConnectivityCircuitOpenError("No internet connection")
+
+    def record_success(self):
+        with self.lock:
+            self.failure_count = 0
+            self.is_trial_in_progress = False
+            self.set_state("closed")
+
+    def release_trial(self):
+        # a cancelled request says nothing about the connection, so the next request becomes the trial
+        with self.lock:
+            self.is_trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failure_count += 1
+            self.is_trial_in_progress = False
+            if (
+                self.state == "half_open"
+                or self.failure_count >= self.failure_threshold
+            ):
+                self.opened_timestamp = time.monotonic()
+                self.set_state("open")
+
+    def request(self, make_request: Callable, *args, **kwargs):
+        self.before_request()
+        try:
+            result = make_request(*args, **kwargs)
+        except CONNECTIVITY_ERRORS:
+            self.record_failure()
+            raise
+        except Exception:
+            # any other error came back from the server, so the connection is working
+            self.record_success()
+            raise
+        except BaseException:
+            self.release_trial()
+            raise
+        self.record_success()
+        return result
+
+    async def request_async(
+        self, make_request: Callable[..., Awaitable], *args, **kwargs
+    ):
+        self.before_request()
+        try:
+            result = await make_request(*args, **kwargs)
+        except CONNECTIVITY_ERRORS:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        except BaseException:
+            # eg. asyncio.CancelledError when a background event is cancelled
+            self.release_trial()
+            raise
+        self.record_success()
+        return result
+
+
+connectivity_breaker = ConnectivityCircuitBreaker()
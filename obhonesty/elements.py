@@ -190,6 +190,19 @@ def item_button(item: Item) -> rx.Component:
                                 **{"data-testid": "item_pay_now"},
                             ),
                         ),
+                        rx.dialog.close(
+                            rx.button(
+                                rx.icon("shopping-cart"),
+                                rx.text("Add to cart", size=default_button_text_size),
+                                color_scheme="orange",
+                                size=default_button_size,
+                                on_click=[
+                                    State.add_ordered_item_to_cart,
+                                    State.close_item_dialog,
+                                ],
+                                **{"data-testid": "item_add_to_cart"},
+                            )
+                        ),
                         rx.dialog.close(
                             rx.button(
                                 f"Cancel",
@@ -208,6 +221,85 @@ def item_button(item: Item) -> rx.Component:
     )
 
 
+def cart_row(cart_line: dict) -> rx.Component:
+    return rx.table.row(
+        rx.table.cell(cart_line["item"]),
+        rx.table.cell(cart_line["quantity"]),
+        rx.table.cell(f"€{two_decimal_points(cart_line['total'])}"),
+        rx.table.cell(
+            rx.icon_button(
+                rx.icon("trash-2"),
+                color_scheme="red",
+                variant="soft",
+                on_click=lambda: State.remove_item_from_cart(cart_line["item"]),
+                disabled=State.are_user_buttons_disabled,
+                **{"data-testid": "cart_remove_item"},
+            )
+        ),
+    )
+
+
+def cart() -> rx.Component:
+    return rx.cond(
+        # a paid cart is emptied while its payment dialog is still open
+        (State.cart_lines.length() > 0) | (State.ordered_item == "cart"),
+        rx.vstack(
+            rx.text("Cart", weight="bold", size=default_text_size),
+            rx.table.root(
+                rx.table.header(
+                    rx.table.row(
+                        rx.table.column_header_cell("Item"),
+                        rx.table.column_header_cell("Quantity"),
+                        rx.table.column_header_cell("Total"),
+                        rx.table.column_header_cell(""),
+                    ),
+                ),
+                rx.table.body(rx.foreach(State.cart_lines, cart_row)),
+                **{"data-testid": "cart_table"},
+            ),
+            rx.hstack(
+                rx.text(
+                    f"Total: €{two_decimal_points(State.cart_total)}",
+                    weight="bold",
+                    **{"data-testid": "cart_total"},
+                ),
+                rx.button(
+                    "Register cart (Add to Tab)",
+                    size=default_button_size,
+                    on_click=State.order_cart,
+                    disabled=State.are_user_buttons_disabled,
+                    **{"data-testid": "cart_register"},
+                ),
+                rx.cond(
+                    State.are_payments_enabled,
+                    rx.dialog.root(
+                        rx.dialog.trigger(
+                            rx.button(
+                                rx.icon("credit-card"),
+                                rx.text("Pay Now", size=default_button_text_size),
+                                color_scheme="green",
+                                size=default_button_size,
+                                loading=State.is_order_request_loading,
+                                disabled=State.are_user_buttons_disabled,
+                                on_click=[
+                                    lambda: State.open_item_dialog("cart"),
+                                    State.set_order_request_id,
+                                    lambda: State.show_stripe_item_payment_dialog(
+                                        "cart", State.cart_total
+                                    ),
+                                ],
+                                **{"data-testid": "cart_pay_now"},
+                            )
+                        ),
+                        stripe_payment_dialog("cart", State.cart_total),
+                    ),
+                ),
+                align="center",
+            ),
+        ),
+    )
+
+
 def stripe_payment_dialog(name, amount) -> rx.Component:
     close_dialog_button = rx.dialog.close(
         rx.button(
@@ -1,6 +1,8 @@
 import reflex as rx
-from datetime import datetime, timedelta
-from sqlalchemy import select, func
+from datetime import date, datetime, timedelta
+from typing import Optional
+from sqlalchemy import Index, exists, select, func, or_
+from sqlmodel import Field
 from obhonesty.aux import get_madrid_datetime_now
 
 # These classes specify the table info for the SQL database, storing google sheets data offline.
@@ -10,7 +12,7 @@ from obhonesty.aux import get_madrid_datetime_now
 
 
 class User(rx.Model, table=True):
-    nick_name: str
+    nick_name: str = Field(index=True)
     first_name: str
     last_name: str
     email: str
@@ -29,10 +31,14 @@ class User(rx.Model, table=True):
     def select_users_with_an_active_tab(cls):
         return select(cls).where(cls.has_active_tab == True)
 
+    @classmethod
+    def select_user(cls, nick_name: str):
+        return select(cls).where(cls.nick_name == nick_name)
+
 
 class Order(rx.Model, table=True):
-    order_id: str
-    user_nick_name: str
+    order_id: str = Field(index=True)
+    user_nick_name: str = Field(index=True)
     time: str
     item: str
     quantity: float
@@ -45,11 +51,37 @@ class Order(rx.Model, table=True):
     tax_category: str
     comment: str
     is_synced: bool = False
+    # the time column parsed as Madrid local time, so orders can be found and sorted by time with an index
+    ordered_at: Optional[datetime] = Field(default=None, index=True)
+
+    @classmethod
+    def select_todays_meal_signups(cls):
+        start = datetime.combine(get_madrid_datetime_now().date(), datetime.min.time())
+        end = start + timedelta(days=1)
+        return select(cls).where(
+            cls.ordered_at >= start,
+            cls.ordered_at < end,
+            or_(
+                cls.item == "Breakfast sign-up",
+                cls.item.ilike("Dinner sign-up%"),
+            ),
+        )
+
+    @classmethod
+    def select_unpaid_orders(cls, user_nick_name: str):
+        return (
+            select(cls)
+            .where(
+                cls.user_nick_name == user_nick_name,
+                ~exists().where(Payment.order_id == cls.order_id),
+            )
+            .order_by(cls.ordered_at, cls.id)
+        )
 
 
 class Payment(rx.Model, table=True):
     payment_id: str
-    order_id: str
+    order_id: str = Field(index=True)
     paid_time: datetime
     method: str
     checkout_staff: str
@@ -62,7 +94,7 @@ class Stripe_Checkout_Session(rx.Model, table=True):
     stripe_payment_id: str
     ob_payment_id: str
     order_id: str
-    user: str
+    user: str = Field(index=True)
     is_synced: bool = False
     system_provider_handling_fee_amount: float
     item: str
@@ -75,6 +107,10 @@ class Stripe_Checkout_Session(rx.Model, table=True):
     tax_category: str
     comment: str
 
+    @classmethod
+    def select_user_sessions(cls, user: str):
+        return select(cls).where(cls.user == user)
+
 
 class Item(rx.Model, table=True):
     name: str
@@ -89,11 +125,11 @@ class Admin(rx.Model, table=True):
 
 
 class Meal(rx.Model, table=True):
-    meal_id: str
-    order_id: str
+    meal_id: str = Field(index=True)
+    order_id: str = Field(index=True)
     user_nick_name: str
-    receiver: str
-    order_time: datetime
+    receiver: str = Field(index=True)
+    order_time: datetime = Field(index=True)
     meal_type: str
     diet: str
     allergies: str
@@ -127,19 +163,22 @@ class Meal(rx.Model, table=True):
 
     @classmethod
     def get_todays_meal_counts(cls):
-        start = datetime.combine(get_madrid_datetime_now().date(), datetime.min.time())
-        end = start + timedelta(days=1)
-        query_args = [
-            cls.volunteer,
-            cls.meal_type,
-            cls.diet,
-            cls.served,
-        ]
         counts = (
             rx.session()
-            .query(*query_args, func.count())
-            .filter(cls.order_time >= start, cls.order_time < end)
-            .group_by(*query_args)
+            .query(
+                Meal_Count.volunteer,
+                Meal_Count.meal_type,
+                Meal_Count.diet,
+                Meal_Count.served,
+                func.sum(Meal_Count.count),
+            )
+            .filter(Meal_Count.meal_date == get_madrid_datetime_now().date())
+            .group_by(
+                Meal_Count.volunteer,
+                Meal_Count.meal_type,
+                Meal_Count.diet,
+                Meal_Count.served,
+            )
             .all()
         )
         totals = {
@@ -170,8 +209,146 @@ class Meal(rx.Model, table=True):
 
 class Checkout(rx.Model, table=True):
     checkout_id: str
-    user: str
+    user: str = Field(index=True)
     checkout_datetime: datetime
     checkout_origin: str
     checkout_origin_payment_id: str
     is_synced: bool = False
+
+
+class Meal_Count(rx.Model, table=True):
+    # the number of meals for each day and kind of meal, kept up to date in the same transaction as the meals are added, removed or served
+    # a kind of meal can have more than one row if two transactions add it at the same time, so the counts must be summed
+    meal_date: date = Field(index=True)
+    meal_type: str
+    volunteer: bool
+    diet: str
+    served: bool
+    count: int = 0
+
+    @classmethod
+    def get_key(cls, meal_values: dict) -> tuple[date, str, bool, str, bool]:
+        return (
+            meal_values["order_time"].date(),
+            meal_values["meal_type"],
+            meal_values["volunteer"],
+            meal_values["diet"],
+            meal_values["served"],
+        )
+
+    @classmethod
+    def add_changes(cls, session, count_changes: dict[tuple, int]):
+        with session.no_autoflush:
+            for (
+                meal_date,
+                meal_type,
+                volunteer,
+                diet,
+                served,
+            ), change in count_changes.items():
+                if not change:
+                    continue
+                meal_count = (
+                    session.query(cls)
+                    .filter(
+                        cls.meal_date == meal_date,
+                        cls.meal_type == meal_type,
+                        cls.volunteer == volunteer,
+                        cls.diet == diet,
+                        cls.served == served,
+                    )
+                    .first()
+                )
+                if meal_count is None:
+                    session.add(
+                        cls(
+                            meal_date=meal_date,
+                            meal_type=meal_type,
+                            volunteer=volunteer,
+                            diet=diet,
+                            served=served,
+                            count=change,
+                        )
+                    )
+                else:
+                    # incremented in the database, so concurrent changes are not lost
+                    meal_count.count = cls.count + change
+
+    @classmethod
+    def rebuild(cls, session):
+        session.query(cls).delete(synchronize_session=False)
+        meal_date = func.date(Meal.order_time)
+        for row in (
+            session.query(
+                meal_date,
+                Meal.meal_type,
+                Meal.volunteer,
+                Meal.diet,
+                Meal.served,
+                func.count(),
+            )
+            .group_by(meal_date, Meal.meal_type, Meal.volunteer, Meal.diet, Meal.served)
+            .all()
+        ):
+            session.add(
+                cls(
+                    # sqlite returns the date as text
+                    meal_date=(
+                        date.fromisoformat(row[0])
+                        if isinstance(row[0], str)
+                        else row[0]
+                    ),
+                    meal_type=row[1],
+                    volunteer=row[2],
+                    diet=row[3],
+                    served=row[4],
+                    count=row[5],
+                )
+            )
+
+
+class Sheet_Sync_State(rx.Model, table=True):
+    # high-water mark for sheets that are synced incrementally, row_count excludes the header row
+    sheet: str = Field(index=True)
+    row_count: int = 0
+    tail_checksum: str = ""
+    last_full_sync_timestamp: float = 0
+    # hash of the sheet content last written to the table, the version goes up each time it changes so caches can be keyed on it
+    content_hash: str = ""
+    version: int = 0
+
+    @classmethod
+    def get_version(cls, session, sheet: str) -> int:
+        return session.query(cls.version).filter(cls.sheet == sheet).scalar() or 0
+
+
+class Sheet_Outbox(rx.Model, table=True):
+    # sheet writes that are waiting to be made, row_key is the local row's sheet id, eg. the order_id or nick_name
+    idempotency_key: str = Field(index=True)
+    sheet: str
+    operation: str
+    row_key: str
+    # pending, in_progress, done or dead, dead entries have failed too many times and are no longer retried
+    # an in_progress entry is being written by the worker that claimed it, until its next_attempt_timestamp
+    status: str = Field(default="pending", index=True)
+    attempts: int = 0
+    next_attempt_timestamp: float = 0
+    last_error: str = ""
+    created_timestamp: float = 0
+    written_timestamp: float = 0
+
+
+# the sync looks up the rows waiting to be synced with ~model.is_synced, so only those rows are indexed
+# the index condition is built from the same expression, as the planner only uses a partial index whose condition matches the query's
+SYNCED_MODELS = [User, Order, Payment, Stripe_Checkout_Session, Checkout]
+for synced_model in SYNCED_MODELS:
+    Index(
+        f"ix_{synced_model.__tablename__}_unsynced",
+        synced_model.__table__.c.is_synced,
+        sqlite_where=~synced_model.__table__.c.is_synced,
+        postgresql_where=~synced_model.__table__.c.is_synced,
+    )
+
+
+def select_unsynced_rows(model: type[rx.Model]):
+    return select(model).where(~model.is_synced)
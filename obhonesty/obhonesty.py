@@ -1,10 +1,28 @@
 from datetime import datetime
 import reflex as rx
-from sqlalchemy import select, or_
+import stripe
+from sqlalchemy import select, exists, event, inspect, update
+from sqlalchemy.orm import Session
 import asyncio
 from obhonesty.pages import *
 from obhonesty.state import State
+from obhonesty.sync_scheduler import sync_scheduler
+from obhonesty.connectivity import (
+    ConnectivityCircuitOpenError,
+    is_connectivity_error,
+)
+from obhonesty.sheet_rate_limiter import SheetRateLimitError
+from obhonesty.sheet_pusher import DebouncedSheetPusher
+from obhonesty.shared_cache import shared_table_cache
+from obhonesty.change_bus import change_bus, get_changed_row_keys
+from obhonesty.stripe_payments import (
+    STRIPE_WEBHOOK_SECRET,
+    stripe_session_expiry_queue,
+    stripe_session_poller,
+)
 from obhonesty.sheet import (
+    RateLimitedWorksheet,
+    batch_get_sheet_values,
     user_sheet,
     item_sheet,
     order_sheet,
@@ -19,34 +37,106 @@ from obhonesty.models import (
     Item,
     Admin,
     Meal,
+    Meal_Count,
     Stripe_Checkout_Session,
     Payment,
     Checkout,
+    Sheet_Sync_State,
+    Sheet_Outbox,
+    select_unsynced_rows,
 )
 from obhonesty.aux import (
-    check_internet_connection,
     get_model_string_type_columns,
+    get_rows_checksum,
     sanitise_record_strings,
     generate_uuid,
     generate_receiver_from_names,
     get_madrid_datetime_now,
-    get_todays_date_as_string,
+    get_order_time_as_datetime,
 )
 import os
-from fastapi import FastAPI, status
-from typing import TypedDict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import APIRouter, FastAPI, HTTPException, Request, status
+from typing import Callable, NamedTuple, Optional
 from gspread import Cell
+from gspread.utils import numericise_all
 from zoneinfo import ZoneInfo
 
 
-class UnsyncedUserWithRow(TypedDict):
-    row: int
-    user: User
+class UserSheetRowCache:
+    """Sheet row numbers of each user from the last user sync, so updated users can be written without pulling the whole sheet.
+    Rows can move if staff edit the sheet, so the rows are only trusted for a short time.
+    """
+
+    def __init__(self, max_age_seconds: float):
+        self.max_age_seconds = max_age_seconds
+        self.rows: dict[str, int] = {}
+        self.updated_timestamp: float = 0
+
+    def update(self, rows: dict[str, int]):
+        self.rows = rows
+        self.updated_timestamp = time.time()
+
+    def get_row(self, nick_name: str) -> Optional[int]:
+        if time.time() - self.updated_timestamp > self.max_age_seconds:
+            return None
+        return self.rows.get(nick_name)
+
+    def clear(self):
+        self.rows = {}
 
 
 is_test_environment = True if os.getenv("TEST") else False
+# the sync steps make blocking Google Sheets and database calls, so they run in their own threads to keep the event loop free for the tablets
+sync_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SYNC_WORKER_COUNT", 2)),
+    thread_name_prefix="sheet-sync",
+)
+ORDER_SHEET_LAST_COLUMN = "M"
+# the last rows of the order sheet are re-read every cycle and compared against the checksum from the previous cycle to detect edits
+ORDER_SYNC_TAIL_ROW_COUNT = 50
+# edits above the tail rows cannot be detected by the checksum, so the full sheet is still reconciled periodically
+ORDER_FULL_SYNC_INTERVAL_SECONDS = (
+    int(os.getenv("ORDER_FULL_SYNC_INTERVAL_MINUTES", 60)) * 60
+)
+SHEET_OUTBOX_MAX_ATTEMPTS = int(os.getenv("SHEET_OUTBOX_MAX_ATTEMPTS", 10))
+# the first retry waits for the next sync, which marks a write as done if it reached the sheet despite failing
+SHEET_OUTBOX_RETRY_BASE_SECONDS = 20
+SHEET_OUTBOX_RETRY_MAX_SECONDS = 15 * 60
+# user updates wait for the next user sync to find the user's sheet row
+SHEET_OUTBOX_UNKNOWN_ROW_RETRY_SECONDS = 30
+# appended rows that the sync has not seen in the sheet after this long are appended again
+SHEET_OUTBOX_UNSEEN_WRITE_SECONDS = 5 * 60
+# a claimed entry is claimed again after this long, in case its worker stopped before finishing the write
+SHEET_OUTBOX_CLAIM_SECONDS = 5 * 60
+sheet_pusher = DebouncedSheetPusher(
+    debounce_seconds=float(os.getenv("SHEET_PUSH_DEBOUNCE_SECONDS", 2))
+)
+# how often the sync scheduler checks which tables are due
+SYNC_TICK_SECONDS = float(os.getenv("SYNC_TICK_SECONDS", 5))
+USER_SHEET_HEADERS = [
+    "nick_name",
+    "first_name",
+    "last_name",
+    "phone_number",
+    "email",
+    "diet",
+    "allergies",
+    "volunteer",
+    "away",
+    "owes",
+    "is_current_guest",
+    "has_active_tab",
+    "prepaid_dinners_quantity",
+]
+USER_STRING_TYPE_COLUMNS = get_model_string_type_columns(User)
+user_sheet_row_cache = UserSheetRowCache(max_age_seconds=5 * 60)
 fastapi_app = FastAPI(title="Honesty Bar API")
-app = rx.App() if not is_test_environment else rx.App(api_transformer=fastapi_app)
+# the test routes are only served in the test environment
+test_router = APIRouter(prefix="/api/test")
+stripe_router = APIRouter(prefix="/api/stripe")
+app = rx.App(api_transformer=fastapi_app)
 app.add_page(
     index,
     route="/",
@@ -99,7 +189,7 @@ app.add_page(
 )
 
 
-@fastapi_app.post("/api/test/user", status_code=status.HTTP_201_CREATED)
+@test_router.post("/user", status_code=status.HTTP_201_CREATED)
 async def create_test_user(
     username: str, volunteer: str = "", prepaid_dinners_quantity=0
 ):
@@ -126,21 +216,21 @@ async def create_test_user(
     return {"username": username, "message": "Test user created successfully"}
 
 
-@fastapi_app.get("/api/test/checkout")
+@test_router.get("/checkout")
 async def get_checkout(username: str):
     checkout = rx.session().query(Checkout).filter(Checkout.user == username).first()
     return {"checkout": checkout.model_dump()}
 
 
-@fastapi_app.get("/api/test/user")
+@test_router.get("/user")
 async def get_user(
     username: str,
 ):
-    user = rx.session().query(User).filter(User.nick_name == username).first()
+    user = rx.session().exec(User.select_user(username)).scalars().first()
     return {"user": user.model_dump()}
 
 
-@fastapi_app.post("/api/test/orders", status_code=status.HTTP_201_CREATED)
+@test_router.post("/orders", status_code=status.HTTP_201_CREATED)
 async def create_test_order(
     order_id: str,
     user_nick_name: str,
@@ -162,6 +252,7 @@ async def create_test_order(
                 order_id=order_id,
                 user_nick_name=user_nick_name,
                 time=time,
+                ordered_at=get_order_time_as_datetime(time),
                 item=item,
                 quantity=quantity,
                 price=price,
@@ -178,19 +269,19 @@ async def create_test_order(
     return {"order_id": order_id, "message": "Test order created successfully"}
 
 
-@fastapi_app.get("/api/test/orders")
+@test_router.get("/orders")
 async def get_test_orders(username: str):
     with rx.session() as session:
         orders = session.query(Order).filter(Order.user_nick_name == username).all()
         return {"orders": [order.model_dump() for order in orders]}
 
 
-@fastapi_app.get("/api/test/stripe-checkout-sessions")
+@test_router.get("/stripe-checkout-sessions")
 async def get_stripe_checkout_sessions(username: str):
     with rx.session() as session:
         checkout_sessions = (
-            session.query(Stripe_Checkout_Session)
-            .filter(Stripe_Checkout_Session.user == username)
+            session.exec(Stripe_Checkout_Session.select_user_sessions(username))
+            .scalars()
             .all()
         )
         return {
@@ -200,14 +291,14 @@ async def get_stripe_checkout_sessions(username: str):
         }
 
 
-@fastapi_app.get("/api/test/payments")
+@test_router.get("/payments")
 async def get_payment(order_id: str):
     with rx.session() as session:
         payment = session.query(Payment).filter(Payment.order_id == order_id).first()
     return {"payment": payment.model_dump() if payment else "None found"}
 
 
-@fastapi_app.get("/api/test/meals/dinner/today")
+@test_router.get("/meals/dinner/today")
 async def get_todays_dinner_meals():
     with rx.session() as session:
         todays_dinner_meals = (
@@ -216,7 +307,7 @@ async def get_todays_dinner_meals():
     return {"meals": [row.model_dump() for row in todays_dinner_meals]}
 
 
-@fastapi_app.post("/api/test/meals/dinner/today", status_code=status.HTTP_201_CREATED)
+@test_router.post("/meals/dinner/today", status_code=status.HTTP_201_CREATED)
 async def create_dinner_meal_for_today(username: str, receiver: str):
     meal_id = generate_uuid()
     with rx.session() as session:
@@ -238,103 +329,675 @@ async def create_dinner_meal_for_today(username: str, receiver: str):
     return {"meal_id": meal_id, "message": "Test meal created successfully"}
 
 
-@fastapi_app.post("/api/test/stripe/trigger")
+@test_router.post("/stripe/trigger")
 async def trigger_stripe_session_response(stripe_test_state: str, token: str):
     async with app.modify_state(token) as root_state:
         state = await root_state.get_state(State)
         state.stripe_test_state = stripe_test_state
 
 
-@fastapi_app.get("/api/test/stripe/line-items")
+@test_router.get("/stripe/line-items")
 async def get_stripe_line_items(token: str):
     async with app.modify_state(token) as root_state:
         state = await root_state.get_state(State)
         return {"line_items": state.test_line_items}
 
 
-def get_records(sheet, headers: list[str] = [], add_synced: bool = False):
-    check_internet_connection()
-    if sheet is None:
-        return []
-    records = sheet.get_all_records(expected_headers=headers)
+@test_router.get("/stripe/session")
+async def get_stripe_session(token: str):
+    async with app.modify_state(token) as root_state:
+        state = await root_state.get_state(State)
+        return {
+            "stripe_session_id": state.current_stripe_session_id,
+            "ob_payment_id": state.ob_payment_id,
+        }
+
+
+if is_test_environment:
+    fastapi_app.include_router(test_router)
 
-    for record in records:
+
+@stripe_router.post("/webhook")
+async def receive_stripe_webhook(request: Request):
+    try:
+        event = stripe.Webhook.construct_event(
+            await request.body(),
+            request.headers.get("stripe-signature", ""),
+            STRIPE_WEBHOOK_SECRET,
+        )
+    except (ValueError, stripe.SignatureVerificationError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        await stripe_session_poller.handle_webhook_event(event)
+    except Exception as e:
+        # Stripe sends the event again later, and the poller checks the session in the meantime
+        print(f"Stripe webhook error: {e} - {get_madrid_datetime_now()}", flush=True)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e)
+        )
+    return {"received": True}
+
+
+# any payload signed with an empty secret would pass verification, so the webhook is only served once a secret is set
+if STRIPE_WEBHOOK_SECRET:
+    fastapi_app.include_router(stripe_router)
+
+
+def get_records_from_rows(
+    headers: list[str], rows: list[list], add_synced: bool = False
+):
+    # mirrors gspread's get_all_records for rows that have been fetched as a range
+    records = []
+    for row in rows:
+        record = dict(zip(headers, numericise_all(row)))
         if "" in record:
             del record[""]
+        records.append({**record, "is_synced": True} if add_synced else record)
+    return records
+
 
+def get_records_from_values(
+    values: list[list], expected_headers: list[str] = [], add_synced: bool = False
+):
+    if not len(values):
+        return []
+    headers = values[0]
+    missing_headers = set(expected_headers) - set(headers)
+    if len(missing_headers):
+        raise Exception(f"the sheet is missing the headers: {missing_headers}")
+    return get_records_from_rows(
+        headers, pad_rows(values[1:], len(headers)), add_synced
+    )
+
+
+def pad_rows(rows, width: int) -> list[list]:
+    return [list(row) + [""] * (width - len(row)) for row in rows]
+
+
+def get_sheet_sync_state(session, sheet_name: str) -> Sheet_Sync_State:
+    sync_state = (
+        session.query(Sheet_Sync_State)
+        .filter(Sheet_Sync_State.sheet == sheet_name)
+        .first()
+    )
+    if sync_state is None:
+        sync_state = Sheet_Sync_State(sheet=sheet_name)
+        session.add(sync_state)
+    return sync_state
+
+
+def get_changed_sheet_content_hash(
+    sync_state: Sheet_Sync_State, values: list[list]
+) -> Optional[str]:
+    # returns None when the sheet is unchanged since it was last written to the table, so the rewrite can be skipped
+    content_hash = get_rows_checksum(values)
+    return None if content_hash == sync_state.content_hash else content_hash
+
+
+def record_sheet_content_hash(sync_state: Sheet_Sync_State, content_hash: str):
+    sync_state.content_hash = content_hash
+    sync_state.version += 1
+
+
+def is_full_order_sync_due(sync_state: Sheet_Sync_State) -> bool:
     return (
-        [{**record, "is_synced": True} for record in records] if add_synced else records
+        not sync_state.row_count
+        or time.time() - sync_state.last_full_sync_timestamp
+        >= ORDER_FULL_SYNC_INTERVAL_SECONDS
     )
 
 
-def sync_new_orders(unsynced_orders):
-    new_rows = []
-    for order in unsynced_orders:
-        new_rows.append(
-            [
-                order.order_id,
-                order.user_nick_name,
-                order.time,
-                order.item,
-                order.quantity,
-                order.price,
-                order.total,
-                order.receiver,
-                order.diet,
-                order.allergies,
-                order.served,
-                order.tax_category,
-                order.comment,
-            ]
+def get_order_tail_row_count(sync_state: Sheet_Sync_State) -> int:
+    return min(ORDER_SYNC_TAIL_ROW_COUNT, sync_state.row_count)
+
+
+def get_order_sheet_ranges(sync_state: Sheet_Sync_State) -> list[str]:
+    """The whole sheet when a full sync is due, otherwise the header plus the tail rows from the last sync and any rows added since."""
+    if is_full_order_sync_due(sync_state):
+        return [f"A1:{ORDER_SHEET_LAST_COLUMN}"]
+    # sheet rows are 1-indexed and the first row is the header
+    first_row_number = sync_state.row_count - get_order_tail_row_count(sync_state) + 2
+    return [
+        f"A1:{ORDER_SHEET_LAST_COLUMN}1",
+        f"A{first_row_number}:{ORDER_SHEET_LAST_COLUMN}",
+    ]
+
+
+def get_new_order_rows(sync_state: Sheet_Sync_State, order_values: list[list[list]]):
+    """Returns None if the tail rows have changed, as the whole sheet then needs reconciling."""
+    header_values, row_values = order_values
+    headers = header_values[0] if len(header_values) else []
+    rows = pad_rows(row_values, len(headers))
+    tail_row_count = get_order_tail_row_count(sync_state)
+
+    if (
+        len(rows) < tail_row_count
+        or get_rows_checksum(rows[:tail_row_count]) != sync_state.tail_checksum
+    ):
+        return None
+
+    return headers, rows, tail_row_count
+
+
+def get_all_order_rows(values: list[list]):
+    if not len(values):
+        return [], []
+    headers = values[0]
+    return headers, pad_rows(values[1:], len(headers))
+
+
+def get_order_sheet_row(order: Order):
+    return [
+        order.order_id,
+        order.user_nick_name,
+        order.time,
+        order.item,
+        order.quantity,
+        order.price,
+        order.total,
+        order.receiver,
+        order.diet,
+        order.allergies,
+        order.served,
+        order.tax_category,
+        order.comment,
+    ]
+
+
+def get_stripe_checkout_session_sheet_row(
+    stripe_checkout_session: Stripe_Checkout_Session,
+):
+    return [
+        stripe_checkout_session.payment_order_id,
+        stripe_checkout_session.datetime_requested,
+        stripe_checkout_session.stripe_payment_id,
+        stripe_checkout_session.ob_payment_id,
+        stripe_checkout_session.order_id,
+        stripe_checkout_session.user,
+        stripe_checkout_session.system_provider_handling_fee_amount,
+        stripe_checkout_session.item,
+        stripe_checkout_session.quantity,
+        stripe_checkout_session.price,
+        stripe_checkout_session.total,
+        stripe_checkout_session.receiver,
+        stripe_checkout_session.diet,
+        stripe_checkout_session.allergies,
+        stripe_checkout_session.tax_category,
+        stripe_checkout_session.comment,
+    ]
+
+
+def get_payment_sheet_row(payment: Payment):
+    return [
+        payment.payment_id,
+        payment.order_id,
+        datetime.strftime(
+            payment.paid_time.astimezone(ZoneInfo("Europe/Madrid")),
+            DATETIME_FORMAT,
+        ),
+        payment.method,
+        payment.checkout_staff,
+    ]
+
+
+def get_checkout_sheet_row(checkout: Checkout):
+    return [
+        checkout.checkout_id,
+        checkout.user,
+        datetime.strftime(
+            checkout.checkout_datetime.astimezone(ZoneInfo("Europe/Madrid")),
+            DATETIME_FORMAT,
+        ),
+        checkout.checkout_origin,
+        checkout.checkout_origin_payment_id,
+    ]
+
+
+def get_user_sheet_row(user: User):
+    return [
+        user.nick_name,
+        user.first_name,
+        user.last_name,
+        user.phone_number,
+        user.email,
+        user.diet,
+        user.allergies,
+        user.volunteer,
+        user.away,
+        "",
+        user.is_current_guest,
+        user.has_active_tab,
+        user.prepaid_dinners_quantity if user.prepaid_dinners_quantity else "",
+    ]
+
+
+class SheetWriter(NamedTuple):
+    model: type
+    id_column_name: str
+    sheet: RateLimitedWorksheet
+    get_sheet_row: Callable
+
+
+# models whose local rows are written to their sheet through the outbox, keyed by the outbox's sheet name
+SHEET_WRITERS: dict[str, SheetWriter] = {
+    "orders": SheetWriter(Order, "order_id", order_sheet, get_order_sheet_row),
+    "users": SheetWriter(User, "nick_name", user_sheet, get_user_sheet_row),
+    "stripe_payments": SheetWriter(
+        Stripe_Checkout_Session,
+        "payment_order_id",
+        stripe_payments_sheet,
+        get_stripe_checkout_session_sheet_row,
+    ),
+    "payments": SheetWriter(
+        Payment, "payment_id", payments_sheet, get_payment_sheet_row
+    ),
+    "checkouts": SheetWriter(
+        Checkout, "checkout_id", checkouts_sheet, get_checkout_sheet_row
+    ),
+}
+SHEET_WRITER_NAMES = {
+    writer.model: sheet_name for sheet_name, writer in SHEET_WRITERS.items()
+}
+
+
+def get_sheet_outbox_idempotency_key(sheet_name: str, operation: str, row_key: str):
+    return f"{sheet_name}:{operation}:{row_key}"
+
+
+def add_sheet_outbox_entries(session, sheet_name: str, operation: str, row_keys):
+    """Adds an outbox entry for each row that does not have one yet, in the caller's transaction.
+    A row is only ever appended once, while a user is updated again once their previous update has been written.
+    """
+    row_keys_by_idempotency_key = {
+        get_sheet_outbox_idempotency_key(sheet_name, operation, row_key): row_key
+        for row_key in row_keys
+    }
+    if not len(row_keys_by_idempotency_key):
+        return
+    existing_entries_query = session.query(Sheet_Outbox.idempotency_key).filter(
+        Sheet_Outbox.idempotency_key.in_(list(row_keys_by_idempotency_key))
+    )
+    if operation == "update":
+        existing_entries_query = existing_entries_query.filter(
+            Sheet_Outbox.status == "pending"
         )
-    order_sheet.append_rows(
-        new_rows, value_input_option="USER_ENTERED", table_range="A1"
+    with session.no_autoflush:
+        existing_idempotency_keys = set(
+            idempotency_key for (idempotency_key,) in existing_entries_query.all()
+        )
+
+    for idempotency_key, row_key in row_keys_by_idempotency_key.items():
+        if idempotency_key in existing_idempotency_keys:
+            continue
+        session.add(
+            Sheet_Outbox(
+                idempotency_key=idempotency_key,
+                sheet=sheet_name,
+                operation=operation,
+                row_key=row_key,
+                created_timestamp=time.time(),
+            )
+        )
+        session.info["has_new_sheet_outbox_entries"] = True
+
+
+def add_sheet_outbox_appends_for_unseen_rows(session, sheet_name: str, row_keys):
+    # rows that were appended a while ago but are still missing from the sheet have been removed from it, so they are appended again
+    add_sheet_outbox_entries(session, sheet_name, "append", row_keys)
+    requeued_entry_count = (
+        session.query(Sheet_Outbox)
+        .filter(
+            Sheet_Outbox.idempotency_key.in_(
+                [
+                    get_sheet_outbox_idempotency_key(sheet_name, "append", row_key)
+                    for row_key in row_keys
+                ]
+            ),
+            Sheet_Outbox.status == "done",
+            Sheet_Outbox.written_timestamp
+            < time.time() - SHEET_OUTBOX_UNSEEN_WRITE_SECONDS,
+        )
+        .update(
+            {"status": "pending", "attempts": 0, "next_attempt_timestamp": 0},
+            synchronize_session=False,
+        )
+    )
+    if requeued_entry_count:
+        session.info["has_new_sheet_outbox_entries"] = True
+
+
+def mark_sheet_outbox_entries_done(session, sheet_name: str, operation: str, row_keys):
+    # the rows are in the sheet, so writes that are still waiting or have been given up on are no longer needed
+    idempotency_keys = [
+        get_sheet_outbox_idempotency_key(sheet_name, operation, row_key)
+        for row_key in row_keys
+    ]
+    if not len(idempotency_keys):
+        return
+    session.query(Sheet_Outbox).filter(
+        Sheet_Outbox.idempotency_key.in_(idempotency_keys),
+        Sheet_Outbox.status != "done",
+    ).update(
+        {"status": "done", "written_timestamp": time.time()},
+        synchronize_session=False,
+    )
+
+
+def get_sheet_outbox_retry_seconds(attempts: int) -> float:
+    return min(
+        SHEET_OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+        SHEET_OUTBOX_RETRY_MAX_SECONDS,
     )
 
 
-def sync_new_users(unsynced_users: list[User]):
-    new_rows = []
-    for user in unsynced_users:
-        new_rows.append(
+def record_sheet_outbox_failure(entries: list[Sheet_Outbox], error: Exception):
+    for entry in entries:
+        entry.status = "pending"
+        entry.last_error = str(error)
+        if is_connectivity_error(error) or isinstance(error, SheetRateLimitError):
+            # being offline or over the quota is not the write's fault, so it does not count towards the attempts
+            entry.next_attempt_timestamp = time.time() + SHEET_OUTBOX_RETRY_BASE_SECONDS
+            continue
+        entry.attempts += 1
+        if entry.attempts >= SHEET_OUTBOX_MAX_ATTEMPTS:
+            entry.status = "dead"
+            print(
+                f"Sheet outbox entry {entry.idempotency_key} failed {entry.attempts} times and will not be retried: {error}",
+                flush=True,
+            )
+            continue
+        entry.next_attempt_timestamp = time.time() + get_sheet_outbox_retry_seconds(
+            entry.attempts
+        )
+
+
+def write_sheet_outbox_entries(
+    session, sheet_name: str, operation: str, entries: list[Sheet_Outbox]
+):
+    writer = SHEET_WRITERS[sheet_name]
+    id_column = getattr(writer.model, writer.id_column_name)
+    rows_by_key = {
+        getattr(row, writer.id_column_name): row
+        for row in session.query(writer.model)
+        .filter(id_column.in_([entry.row_key for entry in entries]))
+        .all()
+    }
+    entries_to_write: list[Sheet_Outbox] = []
+    for entry in entries:
+        if entry.row_key not in rows_by_key:
+            entry.status = "dead"
+            entry.last_error = "The row no longer exists in the local database"
+            continue
+        entries_to_write.append(entry)
+    if not len(entries_to_write):
+        return
+
+    if operation == "append":
+        writer.sheet.append_rows(
             [
-                user.nick_name,
-                user.first_name,
-                user.last_name,
-                user.phone_number,
-                user.email,
-                user.diet,
-                user.allergies,
-                user.volunteer,
-                user.away,
-                "",
-                user.is_current_guest,
-                user.has_active_tab,
-                user.prepaid_dinners_quantity if user.prepaid_dinners_quantity else "",
-            ]
+                writer.get_sheet_row(rows_by_key[entry.row_key])
+                for entry in entries_to_write
+            ],
+            value_input_option="USER_ENTERED",
+            table_range="A1",
+        )
+        unwritten_row_keys = set()
+    else:
+        # only the users are updated in place
+        unwritten_row_keys = sync_updated_users(
+            [rows_by_key[entry.row_key] for entry in entries_to_write]
         )
-    user_sheet.append_rows(
-        new_rows, value_input_option="USER_ENTERED", table_range="A1"
+
+    for entry in entries_to_write:
+        if entry.row_key in unwritten_row_keys:
+            entry.status = "pending"
+            entry.next_attempt_timestamp = (
+                time.time() + SHEET_OUTBOX_UNKNOWN_ROW_RETRY_SECONDS
+            )
+            continue
+        entry.status = "done"
+        entry.written_timestamp = time.time()
+
+
+def flush_sheet_outbox():
+    """Makes every outbox write that is due, batching the writes to each sheet into a single request.
+    Failed writes are retried with an exponential backoff until they are given up on as dead.
+    """
+    with rx.session() as session:
+        now = time.time()
+        # the due entries are claimed in a single UPDATE, so each one is only written by one thread or worker
+        # entries whose claim has run out, eg. because their worker stopped mid-write, are claimed again
+        claimed_entry_ids: list[int] = (
+            session.execute(
+                update(Sheet_Outbox)
+                .where(
+                    Sheet_Outbox.status.in_(["pending", "in_progress"]),
+                    Sheet_Outbox.next_attempt_timestamp <= now,
+                )
+                .values(
+                    status="in_progress",
+                    next_attempt_timestamp=now + SHEET_OUTBOX_CLAIM_SECONDS,
+                )
+                .returning(Sheet_Outbox.id)
+                .execution_options(synchronize_session=False)
+            )
+            .scalars()
+            .all()
+        )
+        session.commit()
+        if not len(claimed_entry_ids):
+            return
+
+        claimed_entries: list[Sheet_Outbox] = (
+            session.query(Sheet_Outbox)
+            .filter(Sheet_Outbox.id.in_(claimed_entry_ids))
+            .order_by(Sheet_Outbox.id)
+            .all()
+        )
+        entries_by_write: dict[tuple[str, str], list[Sheet_Outbox]] = {}
+        for entry in claimed_entries:
+            entries_by_write.setdefault((entry.sheet, entry.operation), []).append(
+                entry
+            )
+
+        for (sheet_name, operation), entries in entries_by_write.items():
+            try:
+                write_sheet_outbox_entries(session, sheet_name, operation, entries)
+            except Exception as e:
+                # the circuit breaker has already logged that the connection is down
+                if not isinstance(e, ConnectivityCircuitOpenError):
+                    print(
+                        f"flush_sheet_outbox error for {sheet_name}: {e}",
+                        flush=True,
+                    )
+                record_sheet_outbox_failure(entries, e)
+            # each sheet's writes are committed on their own, so a later failure cannot cause them to be written again
+            session.commit()
+
+
+@event.listens_for(Session, "before_flush")
+def add_sheet_outbox_entries_for_changed_rows(session, flush_context, instances):
+    row_keys_by_write: dict[tuple[str, str], list[str]] = {}
+    for row in session.new:
+        sheet_name = SHEET_WRITER_NAMES.get(type(row))
+        if sheet_name is not None and not row.is_synced:
+            row_keys_by_write.setdefault((sheet_name, "append"), []).append(
+                getattr(row, SHEET_WRITERS[sheet_name].id_column_name)
+            )
+    for row in session.dirty:
+        # the tab and prepaid dinners are the only user columns that are changed locally
+        if isinstance(row, User) and not row.is_synced and session.is_modified(row):
+            row_keys_by_write.setdefault(("users", "update"), []).append(row.nick_name)
+
+    for (sheet_name, operation), row_keys in row_keys_by_write.items():
+        add_sheet_outbox_entries(session, sheet_name, operation, row_keys)
+
+
+@event.listens_for(Session, "after_commit")
+def notify_sheet_pusher_after_commit(session):
+    if session.info.pop("has_new_sheet_outbox_entries", False):
+        sheet_pusher.notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_sheet_outbox_notification(session):
+    session.info.pop("has_new_sheet_outbox_entries", None)
+
+
+MEAL_COUNT_COLUMNS = ["order_time", "meal_type", "volunteer", "diet", "served"]
+
+
+def get_committed_meal_values(meal: Meal) -> dict:
+    meal_values = {}
+    for column in MEAL_COUNT_COLUMNS:
+        history = inspect(meal).attrs[column].history
+        meal_values[column] = (
+            history.deleted[0]
+            if history.deleted
+            else history.unchanged[0] if history.unchanged else getattr(meal, column)
+        )
+    return meal_values
+
+
+@event.listens_for(Session, "before_flush")
+def update_meal_counts_for_changed_meals(session, flush_context, instances):
+    count_changes: dict[tuple, int] = {}
+
+    def add_count_change(meal_values: dict, change: int):
+        key = Meal_Count.get_key(meal_values)
+        count_changes[key] = count_changes.get(key, 0) + change
+
+    for row in session.new:
+        if isinstance(row, Meal):
+            add_count_change(
+                {column: getattr(row, column) for column in MEAL_COUNT_COLUMNS}, 1
+            )
+    for row in session.deleted:
+        if isinstance(row, Meal):
+            add_count_change(get_committed_meal_values(row), -1)
+    for row in session.dirty:
+        if isinstance(row, Meal) and session.is_modified(row):
+            add_count_change(get_committed_meal_values(row), -1)
+            add_count_change(
+                {column: getattr(row, column) for column in MEAL_COUNT_COLUMNS}, 1
+            )
+
+    if len(count_changes):
+        Meal_Count.add_changes(session, count_changes)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def reject_bulk_meal_changes(orm_execute_state):
+    # bulk statements skip the flush, so they would leave the meal counts out of date
+    if (
+        orm_execute_state.is_update or orm_execute_state.is_delete
+    ) and orm_execute_state.is_orm_statement:
+        if (
+            orm_execute_state.bind_mapper is not None
+            and orm_execute_state.bind_mapper.class_ is Meal
+        ):
+            raise ValueError(
+                "Meals must be changed through the session so their counts are updated"
+            )
+
+
+def backfill_order_times():
+    """Fills in the ordered_at column of the orders written before it existed"""
+    try:
+        with rx.session() as session:
+            for order in session.exec(
+                select(Order).where(Order.ordered_at == None)
+            ).scalars():
+                order.ordered_at = get_order_time_as_datetime(order.time)
+            session.commit()
+    except Exception as e:
+        print(f"backfill_order_times error: {e}")
+
+
+def rebuild_meal_counts():
+    try:
+        with rx.session() as session:
+            Meal_Count.rebuild(session)
+            session.commit()
+    except Exception as e:
+        print(f"rebuild_meal_counts error: {e}")
+
+
+@event.listens_for(Session, "before_flush")
+def record_changed_tables(session, flush_context, instances):
+    changed_rows = (*session.new, *session.dirty, *session.deleted)
+    session.info.setdefault("changed_tables", set()).update(
+        type(row) for row in changed_rows
     )
+    changed_row_keys = session.info.setdefault("changed_row_keys", {})
+    for topic, row_keys in get_changed_row_keys(changed_rows).items():
+        changed_row_keys.setdefault(topic, set()).update(row_keys)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def record_bulk_changed_tables(orm_execute_state):
+    if (
+        orm_execute_state.is_update or orm_execute_state.is_delete
+    ) and orm_execute_state.bind_mapper is not None:
+        orm_execute_state.session.info.setdefault("changed_tables", set()).add(
+            orm_execute_state.bind_mapper.class_
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def publish_changed_tables_after_commit(session):
+    changed_tables = session.info.pop("changed_tables", None)
+    changed_row_keys = session.info.pop("changed_row_keys", {})
+    if changed_tables:
+        shared_table_cache.invalidate(changed_tables)
+        change_bus.publish_tables(changed_tables, changed_row_keys)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changed_tables(session):
+    session.info.pop("changed_tables", None)
+    session.info.pop("changed_row_keys", None)
 
 
-def sync_updated_users(unsynced_users_with_rows: list[UnsyncedUserWithRow]):
+def sync_updated_users(unsynced_users: list[User]) -> set[str]:
+    """Writes the tab and prepaid dinners of each user to their sheet row, and returns the users whose row is not known yet."""
     updated_cells: list[Cell] = []
-    for unsynced_user_with_row in unsynced_users_with_rows:
+    unwritten_nick_names: set[str] = set()
+    user_rows: dict[str, int] = {}
+    for unsynced_user in unsynced_users:
+        row = user_sheet_row_cache.get_row(unsynced_user.nick_name)
+        if row is None:
+            # the user will be written once the next user sync has found their row
+            unwritten_nick_names.add(unsynced_user.nick_name)
+            continue
+        user_rows[unsynced_user.nick_name] = row
+    if not len(user_rows):
+        return unwritten_nick_names
+
+    # staff may have inserted, deleted or sorted rows since the last user sync, so each row's nick_name is checked before writing to it
+    nick_name_values = user_sheet.batch_get([f"A{row}" for row in user_rows.values()])
+    for (nick_name, row), values in zip(list(user_rows.items()), nick_name_values):
+        if len(values) and len(values[0]) and str(values[0][0]) == str(nick_name):
+            continue
+        del user_rows[nick_name]
+        unwritten_nick_names.add(nick_name)
+        user_sheet_row_cache.clear()
+
+    for unsynced_user in unsynced_users:
+        row = user_rows.get(unsynced_user.nick_name)
+        if row is None:
+            continue
         for column_number, column_name in [
             [12, "has_active_tab"],
             [13, "prepaid_dinners_quantity"],
         ]:
-            value = getattr(unsynced_user_with_row["user"], column_name)
+            value = getattr(unsynced_user, column_name)
             if column_name == "prepaid_dinners_quantity" and not value:
                 value = ""
-            updated_cells.append(
-                Cell(
-                    row=unsynced_user_with_row["row"],
-                    col=column_number,
-                    value=value,
-                )
-            )
-    user_sheet.update_cells(updated_cells, value_input_option="USER_ENTERED")
+            updated_cells.append(Cell(row=row, col=column_number, value=value))
+    if len(updated_cells):
+        user_sheet.update_cells(updated_cells, value_input_option="USER_ENTERED")
+    return unwritten_nick_names
 
 
 def add_google_sheet_data_to_session(session, google_sheet_data, model, id_column_name):
@@ -351,155 +1014,284 @@ def add_google_sheet_data_to_session(session, google_sheet_data, model, id_colum
             )
 
 
-def sync_orders():
+def are_column_values_equal(current_value, new_value):
+    if isinstance(current_value, datetime) and isinstance(new_value, datetime):
+        # datetimes are stored without a timezone, so they are compared as Madrid local time
+        return current_value.replace(tzinfo=None) == new_value.replace(tzinfo=None)
+    return current_value == new_value
+
+
+def reconcile_google_sheet_data(
+    session, google_sheet_data, model, id_column_name, delete_missing: bool = True
+):
+    """Applies only the inserts, updates and deletes needed for the table to match the sheet.
+    Rows that have not been synced yet are left untouched so local changes are never overwritten.
+    Sheet rows that share an id are all kept when they differ, eg. two orders charged under one order id, and a row repeated exactly, eg. by a retried append, is kept once.
+    """
+    has_is_synced_column = "is_synced" in model.__table__.columns
+    column_names = [
+        column_name
+        for column_name in model.__table__.columns.keys()
+        if column_name != "id"
+    ]
+    compared_column_names = [
+        column_name for column_name in column_names if column_name != "is_synced"
+    ]
+    current_rows_query = model.select()
+
+    if not delete_missing:
+        # only the rows that could be affected need loading
+        if not len(google_sheet_data):
+            return
+        current_rows_query = current_rows_query.where(
+            getattr(model, id_column_name).in_(
+                [record[id_column_name] for record in google_sheet_data]
+            )
+        )
+
+    def are_rows_equal(row, other_row) -> bool:
+        return all(
+            are_column_values_equal(
+                getattr(row, column_name), getattr(other_row, column_name)
+            )
+            for column_name in compared_column_names
+        )
+
+    current_rows: dict[str, list] = {}
+    for row in session.exec(current_rows_query).all():
+        current_rows.setdefault(getattr(row, id_column_name), []).append(row)
+
+    google_sheet_rows: dict[str, list] = {}
+    invalid_ids: set[str] = set()
+
+    for index, record in enumerate(google_sheet_data):
+        record_id = record[id_column_name]
+        try:
+            if record_id == "":
+                raise Exception(f"id column '{id_column_name}' is blank")
+            validated_row = model.model_validate(record)
+        except Exception as e:
+            # the existing rows are kept even if the sheet record is invalid
+            invalid_ids.add(record_id)
+            id = record_id if record_id != "" else "N/A"
+            print(
+                f"Unable to add {model.__name__} {id} on row {index + 2}: {e}\nRecord: {record}",
+                flush=True,
+            )
+            continue
+        same_id_rows = google_sheet_rows.setdefault(record_id, [])
+        if not any(are_rows_equal(row, validated_row) for row in same_id_rows):
+            same_id_rows.append(validated_row)
+
+    for record_id, validated_rows in google_sheet_rows.items():
+        if record_id in invalid_ids:
+            continue
+        unmatched_rows = []
+        for current_row in current_rows.pop(record_id, []):
+            matching_row = next(
+                (row for row in validated_rows if are_rows_equal(row, current_row)),
+                None,
+            )
+            if matching_row is None:
+                unmatched_rows.append(current_row)
+                continue
+            validated_rows.remove(matching_row)
+
+        for validated_row in validated_rows:
+            # an incremental sync only contains appended rows, so a row it does not match is new
+            if not delete_missing or not len(unmatched_rows):
+                session.add(validated_row)
+                continue
+            current_row = unmatched_rows.pop(0)
+            if has_is_synced_column and not current_row.is_synced:
+                continue
+            for column_name in column_names:
+                new_value = getattr(validated_row, column_name)
+                if are_column_values_equal(
+                    getattr(current_row, column_name), new_value
+                ):
+                    continue
+                setattr(current_row, column_name, new_value)
+        # the rows left over include duplicates left behind by the previous delete and reinsert syncs
+        current_rows[record_id] = unmatched_rows
+
+    if delete_missing:
+        for row_id, rows in current_rows.items():
+            if row_id in invalid_ids:
+                continue
+            for row in rows:
+                if has_is_synced_column and not row.is_synced:
+                    continue
+                session.delete(row)
+
+
+def sync_orders(order_values: list[list[list]]) -> bool:
     try:
         order_string_columns = get_model_string_type_columns(Order)
 
         with rx.session() as session:
-            order_data = get_records(
-                order_sheet,
-                [
-                    "order_id",
-                    "user",
-                    "time",
-                    "item",
-                    "quantity",
-                    "price",
-                    "total",
-                    "diet",
-                    "allergies",
-                    "served",
-                    "tax_category",
-                    "comment",
-                ],
-                True,
+            sync_state = get_sheet_sync_state(session, "orders")
+            is_full_sync = len(order_values) == 1
+            new_order_rows = (
+                None if is_full_sync else get_new_order_rows(sync_state, order_values)
             )
+
+            if new_order_rows is None:
+                headers, rows = get_all_order_rows(
+                    order_values[0]
+                    if is_full_sync
+                    else order_sheet.get(f"A1:{ORDER_SHEET_LAST_COLUMN}")
+                )
+                is_full_sync = True
+                new_rows = rows
+                sync_state.row_count = len(rows)
+                sync_state.last_full_sync_timestamp = time.time()
+            else:
+                headers, rows, tail_row_count = new_order_rows
+                new_rows = rows[tail_row_count:]
+                sync_state.row_count += len(new_rows)
+            sync_state.tail_checksum = get_rows_checksum(
+                rows[len(rows) - get_order_tail_row_count(sync_state) :]
+            )
+
+            order_data = get_records_from_rows(headers, new_rows, True)
+            for order in order_data:
+                order["user_nick_name"] = order["user"]
+                del order["user"]
+                sanitise_record_strings(order_string_columns, order)
+                order["ordered_at"] = get_order_time_as_datetime(order["time"])
+
             current_unsynced_orders = (
-                session.query(Order).filter(~Order.is_synced).all()
+                session.exec(select_unsynced_rows(Order)).scalars().all()
+            )
+            # an incremental sync only contains new rows, so rows missing from it have not been deleted
+            reconcile_google_sheet_data(
+                session, order_data, Order, "order_id", delete_missing=is_full_sync
             )
-            if not len(current_unsynced_orders):
-                for order in order_data:
-                    order["user_nick_name"] = order["user"]
-                    del order["user"]
-                    sanitise_record_strings(order_string_columns, order)
-                for row in session.exec(Order.select()).all():
-                    session.delete(row)
-                add_google_sheet_data_to_session(session, order_data, Order, "order_id")
 
-            google_sheet_order_ids = [order["order_id"] for order in order_data]
-            remaining_unsynced_orders = []
+            google_sheet_order_ids = set(order["order_id"] for order in order_data)
+            synced_order_ids: list[str] = []
+            remaining_unsynced_order_ids: list[str] = []
 
             for order in current_unsynced_orders:
                 if order.order_id in google_sheet_order_ids:
                     order.is_synced = True
+                    synced_order_ids.append(order.order_id)
                     continue
-                remaining_unsynced_orders.append(order)
+                remaining_unsynced_order_ids.append(order.order_id)
 
+            mark_sheet_outbox_entries_done(
+                session, "orders", "append", synced_order_ids
+            )
+            add_sheet_outbox_appends_for_unseen_rows(
+                session, "orders", remaining_unsynced_order_ids
+            )
             session.commit()
-            if len(remaining_unsynced_orders):
-                sync_new_orders(remaining_unsynced_orders)
+        return True
     except Exception as e:
         print(f"sync_orders error: {e}")
+        return False
+
+
+def parse_google_sheets_user(google_sheets_user):
+    del google_sheets_user["owes"]
+    for key in ["volunteer", "away", "is_current_guest", "has_active_tab"]:
+        google_sheets_user[key] = google_sheets_user[key].lower() in [
+            "yes",
+            "true",
+        ]
+    google_sheets_user = sanitise_record_strings(
+        USER_STRING_TYPE_COLUMNS, google_sheets_user
+    )
+    google_sheets_user["prepaid_dinners_quantity"] = (
+        0
+        if google_sheets_user["prepaid_dinners_quantity"] == ""
+        else int(google_sheets_user["prepaid_dinners_quantity"])
+    )
+    return google_sheets_user
 
 
-def sync_users():
+def sync_users(user_values: list[list]) -> bool:
     try:
         with rx.session() as session:
-            google_sheets_user_data = get_records(
-                user_sheet,
-                [
-                    "nick_name",
-                    "first_name",
-                    "last_name",
-                    "phone_number",
-                    "email",
-                    "diet",
-                    "allergies",
-                    "volunteer",
-                    "away",
-                    "owes",
-                    "is_current_guest",
-                    "has_active_tab",
-                    "prepaid_dinners_quantity",
-                ],
-                True,
-            )
-            current_unsynced_users: list[User] = (
-                session.query(User).filter(~User.is_synced).all()
-            )
-            new_unsynced_users_to_sync: list[User] = []
-            updated_unsynced_users_to_sync: list[UnsyncedUserWithRow] = []
-
-            for google_sheets_user in google_sheets_user_data:
-                del google_sheets_user["owes"]
-                for key in ["volunteer", "away", "is_current_guest", "has_active_tab"]:
-                    google_sheets_user[key] = google_sheets_user[key].lower() in [
-                        "yes",
-                        "true",
-                    ]
-                google_sheets_user = sanitise_record_strings(
-                    get_model_string_type_columns(User), google_sheets_user
-                )
-                google_sheets_user["prepaid_dinners_quantity"] = (
-                    0
-                    if google_sheets_user["prepaid_dinners_quantity"] == ""
-                    else int(google_sheets_user["prepaid_dinners_quantity"])
+            google_sheets_user_data = [
+                parse_google_sheets_user(google_sheets_user)
+                for google_sheets_user in get_records_from_values(
+                    user_values, USER_SHEET_HEADERS, True
                 )
+            ]
+            google_sheets_users_by_nick_name: dict[str, dict] = {}
+            user_sheet_rows: dict[str, int] = {}
 
-            if not len(current_unsynced_users):
-                for row in session.exec(User.select()).all():
-                    session.delete(row)
-                add_google_sheet_data_to_session(
-                    session, google_sheets_user_data, User, "nick_name"
-                )
+            for index, google_sheets_user in enumerate(google_sheets_user_data):
+                nick_name = google_sheets_user["nick_name"]
+                if nick_name in google_sheets_users_by_nick_name:
+                    continue
+                google_sheets_users_by_nick_name[nick_name] = google_sheets_user
+                user_sheet_rows[nick_name] = index + 2
+            user_sheet_row_cache.update(user_sheet_rows)
 
-            else:
-                google_sheet_user_nick_names: list[str] = [
-                    google_sheets_user["nick_name"]
-                    for google_sheets_user in google_sheets_user_data
-                ]
+            current_unsynced_users: list[User] = (
+                session.exec(select_unsynced_rows(User)).scalars().all()
+            )
+            reconcile_google_sheet_data(
+                session, google_sheets_user_data, User, "nick_name"
+            )
+            new_unsynced_nick_names: list[str] = []
+            updated_unsynced_nick_names: list[str] = []
+            synced_nick_names: list[str] = []
 
-                for unsynced_user in current_unsynced_users:
-                    if unsynced_user.nick_name not in google_sheet_user_nick_names:
-                        new_unsynced_users_to_sync.append(unsynced_user)
-                        continue
-                    matching_google_sheet_user_index = (
-                        google_sheet_user_nick_names.index(unsynced_user.nick_name)
-                    )
-                    matching_google_sheet_user = google_sheets_user_data[
-                        matching_google_sheet_user_index
+            for unsynced_user in current_unsynced_users:
+                matching_google_sheet_user = google_sheets_users_by_nick_name.get(
+                    unsynced_user.nick_name
+                )
+                if matching_google_sheet_user is None:
+                    new_unsynced_nick_names.append(unsynced_user.nick_name)
+                    continue
+                if not all(
+                    matching_google_sheet_user[column] == getattr(unsynced_user, column)
+                    for column in [
+                        "has_active_tab",
+                        "prepaid_dinners_quantity",
                     ]
-                    if not all(
-                        matching_google_sheet_user[column]
-                        == getattr(unsynced_user, column)
-                        for column in [
-                            "has_active_tab",
-                            "prepaid_dinners_quantity",
-                        ]
-                    ):
-                        updated_unsynced_users_to_sync.append(
-                            {
-                                "row": matching_google_sheet_user_index + 2,
-                                "user": unsynced_user,
-                            }
-                        )
-                        continue
-                    unsynced_user.is_synced = True
+                ):
+                    updated_unsynced_nick_names.append(unsynced_user.nick_name)
+                    continue
+                unsynced_user.is_synced = True
+                synced_nick_names.append(unsynced_user.nick_name)
 
+            # users found in the sheet have been appended, even if their update has not been written yet
+            mark_sheet_outbox_entries_done(
+                session,
+                "users",
+                "append",
+                synced_nick_names + updated_unsynced_nick_names,
+            )
+            mark_sheet_outbox_entries_done(
+                session, "users", "update", synced_nick_names
+            )
+            add_sheet_outbox_appends_for_unseen_rows(
+                session, "users", new_unsynced_nick_names
+            )
+            add_sheet_outbox_entries(
+                session, "users", "update", updated_unsynced_nick_names
+            )
             session.commit()
-            if len(new_unsynced_users_to_sync):
-                sync_new_users(new_unsynced_users_to_sync)
-            if len(updated_unsynced_users_to_sync):
-                sync_updated_users(updated_unsynced_users_to_sync)
+        return True
     except Exception as e:
         print(f"sync_users error: {e}")
+        return False
 
 
-def sync_items():
+def sync_items(item_values: list[list]) -> bool:
     try:
         with rx.session() as session:
-            item_data = get_records(
-                item_sheet, ["name", "price", "description", "tax_category"]
+            sync_state = get_sheet_sync_state(session, "items")
+            content_hash = get_changed_sheet_content_hash(sync_state, item_values)
+            if content_hash is None:
+                return True
+            item_data = get_records_from_values(
+                item_values, ["name", "price", "description", "tax_category"]
             )
 
             for row in session.exec(Item.select()).all():
@@ -530,15 +1322,22 @@ def sync_items():
                         )
                     )
 
+            record_sheet_content_hash(sync_state, content_hash)
             session.commit()
+        return True
     except Exception as e:
         print(f"sync_items error: {e}")
+        return False
 
 
-def sync_admin_data():
+def sync_admin_data(admin_values: list[list]) -> bool:
     try:
         with rx.session() as session:
-            admin_data = get_records(admin_sheet)[0]
+            sync_state = get_sheet_sync_state(session, "admin")
+            content_hash = get_changed_sheet_content_hash(sync_state, admin_values)
+            if content_hash is None:
+                return True
+            admin_data = get_records_from_values(admin_values)[0]
             for row in session.exec(Admin.select()).all():
                 session.delete(row)
             add_google_sheet_data_to_session(
@@ -547,12 +1346,15 @@ def sync_admin_data():
                 Admin,
                 "key",
             )
+            record_sheet_content_hash(sync_state, content_hash)
             session.commit()
+        return True
     except Exception as e:
         print(f"sync_admin_data error: {e}")
+        return False
 
 
-def update_meals_table():
+def update_meals_table() -> bool:
     try:
         with rx.session() as session:
             now = get_madrid_datetime_now()
@@ -561,15 +1363,9 @@ def update_meals_table():
                 session.execute(
                     Meal.select_todays_meals().where(
                         Meal.order_id != "N/A",
-                        Meal.order_id.notin_(
-                            select(Order.order_id).where(
-                                Order.time.ilike(f"{get_todays_date_as_string()}%"),
-                                or_(
-                                    Order.item == "Breakfast sign-up",
-                                    Order.item.ilike("Dinner sign-up%"),
-                                ),
-                            )
-                        ),
+                        ~Order.select_todays_meal_signups()
+                        .where(Order.order_id == Meal.order_id)
+                        .exists(),
                     )
                 ).scalars()
             )
@@ -625,15 +1421,10 @@ def update_meals_table():
                 session.delete(dinner_meal)
             # add new orders to today's meals if not already added
             signups_in_todays_orders: list[Order] = session.execute(
-                select(Order).where(
-                    Order.time.ilike(f"{get_todays_date_as_string()}%"),
-                    or_(
-                        Order.item == "Breakfast sign-up",
-                        Order.item.ilike("Dinner sign-up%"),
-                    ),
-                    Order.order_id.notin_(
-                        Meal.select_todays_meals().with_only_columns(Meal.order_id)
-                    ),
+                Order.select_todays_meal_signups().where(
+                    ~Meal.select_todays_meals()
+                    .where(Meal.order_id == Order.order_id)
+                    .exists()
                 )
             ).scalars()
             for order in signups_in_todays_orders:
@@ -643,9 +1434,9 @@ def update_meals_table():
                         order_id=order.order_id,
                         user_nick_name=order.user_nick_name,
                         receiver=order.receiver,
-                        order_time=datetime.strptime(
-                            order.time, DATETIME_FORMAT
-                        ).replace(tzinfo=ZoneInfo("Europe/Madrid")),
+                        order_time=order.ordered_at.replace(
+                            tzinfo=ZoneInfo("Europe/Madrid")
+                        ),
                         meal_type=(
                             "breakfast"
                             if order.item == "Breakfast sign-up"
@@ -658,14 +1449,16 @@ def update_meals_table():
                     )
                 )
             session.commit()
+        return True
     except Exception as e:
         print(f"update_meal_table error: {e}")
+        return False
 
 
-def sync_new_stripe_checkout_sessions():
+def sync_new_stripe_checkout_sessions(stripe_payment_values: list[list]) -> bool:
     try:
-        stripe_checkout_session_records = get_records(
-            stripe_payments_sheet,
+        stripe_checkout_session_records = get_records_from_values(
+            stripe_payment_values,
             [
                 "payment_order_id",
                 "datetime_requested",
@@ -686,10 +1479,11 @@ def sync_new_stripe_checkout_sessions():
         )
 
         with rx.session() as session:
-            remaining_unsynced_sessions: list[Stripe_Checkout_Session] = []
+            synced_payment_order_ids: list[str] = []
+            remaining_unsynced_payment_order_ids: list[str] = []
             unsynced_stripe_checkout_session_rows = (
-                session.query(Stripe_Checkout_Session)
-                .filter(~Stripe_Checkout_Session.is_synced)
+                session.exec(select_unsynced_rows(Stripe_Checkout_Session))
+                .scalars()
                 .all()
             )
 
@@ -699,45 +1493,29 @@ def sync_new_stripe_checkout_sessions():
                     in stripe_checkout_session_record_payment_ids
                 ):
                     unsynced_session.is_synced = True
+                    synced_payment_order_ids.append(unsynced_session.payment_order_id)
                     continue
-                remaining_unsynced_sessions.append(unsynced_session)
-
-            if len(remaining_unsynced_sessions):
-                stripe_payments_sheet.append_rows(
-                    [
-                        [
-                            remaining_unsynced_session.payment_order_id,
-                            remaining_unsynced_session.datetime_requested,
-                            remaining_unsynced_session.stripe_payment_id,
-                            remaining_unsynced_session.ob_payment_id,
-                            remaining_unsynced_session.order_id,
-                            remaining_unsynced_session.user,
-                            remaining_unsynced_session.system_provider_handling_fee_amount,
-                            remaining_unsynced_session.item,
-                            remaining_unsynced_session.quantity,
-                            remaining_unsynced_session.price,
-                            remaining_unsynced_session.total,
-                            remaining_unsynced_session.receiver,
-                            remaining_unsynced_session.diet,
-                            remaining_unsynced_session.allergies,
-                            remaining_unsynced_session.tax_category,
-                            remaining_unsynced_session.comment,
-                        ]
-                        for remaining_unsynced_session in remaining_unsynced_sessions
-                    ],
-                    value_input_option="USER_ENTERED",
-                    table_range="A1",
+                remaining_unsynced_payment_order_ids.append(
+                    unsynced_session.payment_order_id
                 )
-            session.commit()
 
+            mark_sheet_outbox_entries_done(
+                session, "stripe_payments", "append", synced_payment_order_ids
+            )
+            add_sheet_outbox_appends_for_unseen_rows(
+                session, "stripe_payments", remaining_unsynced_payment_order_ids
+            )
+            session.commit()
+        return True
     except Exception as e:
         print(f"sync_new_stripe_checkout_sessions error: {e}")
+        return False
 
 
-def sync_payments():
+def sync_payments(payment_values: list[list]) -> bool:
     try:
-        payment_data = get_records(
-            payments_sheet,
+        payment_data = get_records_from_values(
+            payment_values,
             [
                 "payment_id",
                 "order_id",
@@ -751,38 +1529,31 @@ def sync_payments():
 
         with rx.session() as session:
             unsynced_payments: list[Payment] = (
-                session.query(Payment).filter(~Payment.is_synced).all()
+                session.exec(select_unsynced_rows(Payment)).scalars().all()
             )
-            remaining_unsynyced_payments: list[Payment] = []
+            synced_payment_ids: list[str] = []
+            remaining_unsynyced_payment_ids: list[str] = []
             for unsynced_payment in unsynced_payments:
                 if unsynced_payment.payment_id in payment_ids:
                     unsynced_payment.is_synced = True
+                    synced_payment_ids.append(unsynced_payment.payment_id)
                     continue
-                remaining_unsynyced_payments.append(unsynced_payment)
+                remaining_unsynyced_payment_ids.append(unsynced_payment.payment_id)
 
+            mark_sheet_outbox_entries_done(
+                session, "payments", "append", synced_payment_ids
+            )
+            add_sheet_outbox_appends_for_unseen_rows(
+                session, "payments", remaining_unsynyced_payment_ids
+            )
             session.commit()
-            if len(remaining_unsynyced_payments):
-                payments_sheet.append_rows(
-                    [
-                        [
-                            unsynced_payment.payment_id,
-                            unsynced_payment.order_id,
-                            datetime.strftime(
-                                unsynced_payment.paid_time.astimezone(
-                                    ZoneInfo("Europe/Madrid")
-                                ),
-                                DATETIME_FORMAT,
-                            ),
-                            unsynced_payment.method,
-                            unsynced_payment.checkout_staff,
-                        ]
-                        for unsynced_payment in remaining_unsynyced_payments
-                    ],
-                    value_input_option="USER_ENTERED",
-                    table_range="A1",
-                )
-                return
+            if len(remaining_unsynyced_payment_ids):
+                return True
 
+            sync_state = get_sheet_sync_state(session, "payments")
+            content_hash = get_changed_sheet_content_hash(sync_state, payment_values)
+            if content_hash is None:
+                return True
             for row in session.exec(Payment.select()).all():
                 session.delete(row)
             for index, payment in enumerate(payment_data):
@@ -792,15 +1563,18 @@ def sync_payments():
             add_google_sheet_data_to_session(
                 session, payment_data, Payment, "payment_id"
             )
+            record_sheet_content_hash(sync_state, content_hash)
             session.commit()
+        return True
     except Exception as e:
         print(f"sync_payments error: {e}")
+        return False
 
 
-def sync_checkouts():
+def sync_checkouts(checkout_values: list[list]) -> bool:
     try:
-        checkout_data = get_records(
-            checkouts_sheet,
+        checkout_data = get_records_from_values(
+            checkout_values,
             [
                 "checkout_id",
                 "user",
@@ -816,38 +1590,31 @@ def sync_checkouts():
 
         with rx.session() as session:
             unsynced_checkouts: list[Checkout] = (
-                session.query(Checkout).filter(~Checkout.is_synced).all()
+                session.exec(select_unsynced_rows(Checkout)).scalars().all()
             )
-            remaining_unsynyced_checkouts: list[Checkout] = []
+            synced_checkout_ids: list[str] = []
+            remaining_unsynyced_checkout_ids: list[str] = []
             for unsynced_checkout in unsynced_checkouts:
                 if unsynced_checkout.checkout_id in checkout_ids:
                     unsynced_checkout.is_synced = True
+                    synced_checkout_ids.append(unsynced_checkout.checkout_id)
                     continue
-                remaining_unsynyced_checkouts.append(unsynced_checkout)
+                remaining_unsynyced_checkout_ids.append(unsynced_checkout.checkout_id)
 
+            mark_sheet_outbox_entries_done(
+                session, "checkouts", "append", synced_checkout_ids
+            )
+            add_sheet_outbox_appends_for_unseen_rows(
+                session, "checkouts", remaining_unsynyced_checkout_ids
+            )
             session.commit()
-            if len(remaining_unsynyced_checkouts):
-                checkouts_sheet.append_rows(
-                    [
-                        [
-                            unsynced_checkout.checkout_id,
-                            unsynced_checkout.user,
-                            datetime.strftime(
-                                unsynced_checkout.checkout_datetime.astimezone(
-                                    ZoneInfo("Europe/Madrid")
-                                ),
-                                DATETIME_FORMAT,
-                            ),
-                            unsynced_checkout.checkout_origin,
-                            unsynced_checkout.checkout_origin_payment_id,
-                        ]
-                        for unsynced_checkout in remaining_unsynyced_checkouts
-                    ],
-                    value_input_option="USER_ENTERED",
-                    table_range="A1",
-                )
-                return
+            if len(remaining_unsynyced_checkout_ids):
+                return True
 
+            sync_state = get_sheet_sync_state(session, "checkouts")
+            content_hash = get_changed_sheet_content_hash(sync_state, checkout_values)
+            if content_hash is None:
+                return True
             for row in session.exec(Checkout.select()).all():
                 session.delete(row)
             for index, checkout in enumerate(checkout_data):
@@ -857,32 +1624,136 @@ def sync_checkouts():
             add_google_sheet_data_to_session(
                 session, checkout_data, Checkout, "checkout_id"
             )
+            record_sheet_content_hash(sync_state, content_hash)
             session.commit()
+        return True
     except Exception as e:
         print(f"sync_checkouts error: {e}")
+        return False
+
+
+def get_tables_with_unsynced_rows() -> list[str]:
+    with rx.session() as session:
+        return [
+            table
+            for table, model in [
+                ("orders", Order),
+                ("users", User),
+                ("stripe_payments", Stripe_Checkout_Session),
+                ("payments", Payment),
+                ("checkouts", Checkout),
+            ]
+            if session.query(exists().where(~model.is_synced)).scalar()
+        ]
+
+
+def sync_sheet_tables(tables: list[str], now: float):
+    """Reads the worksheets of the given tables in a single request and hands each one to its table's sync."""
+    with rx.session() as session:
+        order_sheet_ranges = get_order_sheet_ranges(
+            get_sheet_sync_state(session, "orders")
+        )
+    table_syncs = {
+        "orders": (
+            [(order_sheet, range_name) for range_name in order_sheet_ranges],
+            sync_orders,
+        ),
+        "users": ([(user_sheet, None)], lambda values: sync_users(values[0])),
+        "items": ([(item_sheet, None)], lambda values: sync_items(values[0])),
+        "admin": ([(admin_sheet, None)], lambda values: sync_admin_data(values[0])),
+        "stripe_payments": (
+            [(stripe_payments_sheet, None)],
+            lambda values: sync_new_stripe_checkout_sessions(values[0]),
+        ),
+        "payments": ([(payments_sheet, None)], lambda values: sync_payments(values[0])),
+        "checkouts": (
+            [(checkouts_sheet, None)],
+            lambda values: sync_checkouts(values[0]),
+        ),
+    }
+    sheet_values = batch_get_sheet_values(
+        {table: table_syncs[table][0] for table in tables}
+    )
+
+    for table in tables:
+        # a failed sync is retried soon, and its checksum is not recorded so it is never taken as unchanged
+        if table_syncs[table][1](sheet_values[table]):
+            sync_scheduler.record_sync(
+                table, get_rows_checksum(sheet_values[table]), now
+            )
+        else:
+            sync_scheduler.record_failed_sync(table, now)
+
+
+def sync_google_sheets():
+    for table in get_tables_with_unsynced_rows():
+        sync_scheduler.expedite(table)
+
+    now = time.time()
+    due_tables = sync_scheduler.get_due_tables(now)
+    due_sheet_tables = [table for table in due_tables if table != "meals"]
+
+    if len(due_sheet_tables):
+        try:
+            sync_sheet_tables(due_sheet_tables, now)
+        except ConnectivityCircuitOpenError:
+            pass
+        except Exception as e:
+            print(f"sync_sheet_tables error: {e}")
+
+    # meals follow the orders and volunteers, and must still be updated when offline
+    if "meals" in due_tables or any(
+        table in due_sheet_tables for table in ["orders", "users"]
+    ):
+        if update_meals_table():
+            sync_scheduler.record_sync("meals", "", now)
+        else:
+            sync_scheduler.record_failed_sync("meals", now)
+
+    # retries the writes whose backoff has passed, new writes are flushed by the sheet pusher as soon as they are committed
+    try:
+        flush_sheet_outbox()
+    except Exception as e:
+        print(f"flush_sheet_outbox error: {e}")
+
+
+async def run_sync_step(sync_step):
+    # each step opens its own db session, so it is safe to run outside of the event loop thread
+    await asyncio.get_running_loop().run_in_executor(sync_executor, sync_step)
+
+
+async def run_sheet_pusher():
+    await sheet_pusher.run(flush_sheet_outbox, sync_executor)
+
+
+async def run_stripe_session_poller():
+    await stripe_session_poller.run()
+
+
+async def run_stripe_session_expiry_queue():
+    await stripe_session_expiry_queue.run()
+
+
+async def run_change_bus():
+    await change_bus.run()
 
 
 async def run_loop_tasks():
+    # the order times and meal counts of rows written before this version, or by hand, are made up to date once at startup
+    await run_sync_step(backfill_order_times)
+    await run_sync_step(rebuild_meal_counts)
     while True:
         try:
-            update_meals_table()
-            await asyncio.sleep(5)
-            sync_orders()
-            await asyncio.sleep(5)
-            sync_users()
-            await asyncio.sleep(5)
-            sync_items()
-            await asyncio.sleep(5)
-            sync_admin_data()
-            await asyncio.sleep(5)
-            sync_new_stripe_checkout_sessions()
-            await asyncio.sleep(5)
-            sync_payments()
-            await asyncio.sleep(5)
-            sync_checkouts()
+            await run_sync_step(sync_google_sheets)
         except Exception as e:
             print(f"run_loop_tasks error: {e}")
-        await asyncio.sleep(10)
+        await asyncio.sleep(SYNC_TICK_SECONDS)
 
 
 app.register_lifespan_task(run_loop_tasks)
+app.register_lifespan_task(run_sheet_pusher)
+app.register_lifespan_task(run_change_bus)
+# the test environment has no Stripe account to poll, its payments are confirmed by the test routes and webhook fixtures
+if not is_test_environment:
+    app.register_lifespan_task(run_stripe_session_poller)
+    app.register_lifespan_task(run_stripe_session_expiry_queue)
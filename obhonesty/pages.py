@@ -11,6 +11,7 @@ from obhonesty.elements import (
     user_button_dialog,
     logout_button,
     item_button,
+    cart,
     stripe_payment_dialog,
     admin_last_update_message,
 )
@@ -184,6 +185,7 @@ def user_page() -> rx.Component:
                             align="center",
                         ),
                     ),
+                    cart(),
                     rx.text("Register an item", weight="bold", size=default_text_size),
                     rx.scroll_area(
                         rx.flex(
@@ -0,0 +1,132 @@
+import copy
+import threading
+import time
+from typing import Any, Callable, NamedTuple, Optional
+import reflex as rx
+from obhonesty.models import Admin, Item, Sheet_Sync_State, User
+
+
+class SharedCacheEntry(NamedTuple):
+    value: Any
+    version: int
+    checked_timestamp: float
+
+
+class SharedTableLoader(NamedTuple):
+    load: Callable[[Any], Any]
+    tables: tuple[type, ...]
+    # the sync state sheet whose version changes whenever the sync engine rewrites the table
+    version_sheet: Optional[str]
+
+
+class SharedTableCache:
+    """Holds the rows that every client shows, so they are read from the database once per change instead of once per client.
+    A value is dropped when a committed session changes one of its tables, and loaded again by its next reader.
+    Every recheck_seconds a value is checked against its sheet's sync version, or reloaded if it has none, to notice writes made by other processes.
+    """
+
+    def __init__(self, recheck_seconds: float):
+        self.recheck_seconds = recheck_seconds
+        # only guards the dicts, values are loaded outside of it so one slow load never blocks the other values
+        self.lock = threading.Lock()
+        self.loaders: dict[str, SharedTableLoader] = {}
+        self.entries: dict[str, SharedCacheEntry] = {}
+        # held while a value is loaded, so it is only loaded by one reader at a time
+        self.loading_locks: dict[str, threading.Lock] = {}
+        # a load that started before an invalidation read the old rows, so its value is not kept
+        self.invalidation_counts: dict[str, int] = {}
+
+    def register(
+        self,
+        name: str,
+        load: Callable[[Any], Any],
+        tables: tuple[type, ...],
+        version_sheet: Optional[str] = None,
+    ):
+        self.loaders[name] = SharedTableLoader(load, tables, version_sheet)
+        self.loading_locks[name] = threading.Lock()
+        self.invalidation_counts[name] = 0
+
+    def is_fresh(self, entry: Optional[SharedCacheEntry]) -> bool:
+        return (
+            entry is not None
+            and time.monotonic() - entry.checked_timestamp < self.recheck_seconds
+        )
+
+    def load_entry(
+        self, loader: SharedTableLoader, entry: Optional[SharedCacheEntry]
+    ) -> SharedCacheEntry:
+        now = time.monotonic()
+        with rx.session() as session:
+            version = (
+                Sheet_Sync_State.get_version(session, loader.version_sheet)
+                if loader.version_sheet is not None
+                else 0
+            )
+            if (
+                entry is not None
+                and loader.version_sheet is not None
+                and entry.version == version
+            ):
+                return entry._replace(checked_timestamp=now)
+            return SharedCacheEntry(loader.load(session), version, now)
+
+    def get(self, name: str) -> Any:
+        loader = self.loaders[name]
+        with self.lock:
+            entry = self.entries.get(name)
+        if not self.is_fresh(entry):
+            loading_lock = self.loading_locks[name]
+            # while a value is rechecked its other readers keep using it, only a dropped value is waited for
+            if loading_lock.acquire(blocking=entry is None):
+                try:
+                    with self.lock:
+                        entry = self.entries.get(name)
+                        invalidation_count = self.invalidation_counts[name]
+                    # another reader may have loaded it while this one waited
+                    if not self.is_fresh(entry):
+                        entry = self.load_entry(loader, entry)
+                        with self.lock:
+                            if self.invalidation_counts[name] == invalidation_count:
+                                self.entries[name] = entry
+                finally:
+                    loading_lock.release()
+        # each client gets its own container, the rows in it are shared
+        return copy.copy(entry.value)
+
+    def invalidate(self, changed_tables: set[type]):
+        with self.lock:
+            for name, loader in self.loaders.items():
+                if changed_tables.intersection(loader.tables):
+                    self.entries.pop(name, None)
+                    self.invalidation_counts[name] += 1
+
+
+def load_items(session) -> dict[str, Item]:
+    return {
+        row.name: row for row in session.exec(Item.select()).all() if row.name != ""
+    }
+
+
+def load_admin_data(session) -> dict[str, Any]:
+    admin_data = {}
+    for row in session.exec(Admin.select()).all():
+        if "deadline" in row.key:
+            admin_data[row.key] = row.value
+        elif row.key == "are_payments_enabled":
+            admin_data[row.key] = row.value.lower() == "true"
+        else:
+            admin_data[row.key] = float(row.value)
+    return admin_data
+
+
+def load_users_with_active_tabs(session) -> list[User]:
+    return session.exec(User.select_users_with_an_active_tab()).scalars().all()
+
+
+shared_table_cache = SharedTableCache(recheck_seconds=30)
+shared_table_cache.register("items", load_items, (Item,), "items")
+shared_table_cache.register("admin_data", load_admin_data, (Admin,), "admin")
+shared_table_cache.register(
+    "users_with_active_tabs", load_users_with_active_tabs, (User,)
+)
@@ -1,23 +1,151 @@
 from pathlib import Path
+import threading
+from typing import Callable, Optional
+from google.auth.exceptions import RefreshError
 import gspread
+from gspread.utils import absolute_range_name
 import os
+from obhonesty.connectivity import connectivity_breaker
+from obhonesty.sheet_rate_limiter import SheetRateLimiter, SheetRequestPriority
 
 GSPREAD_SERVICE_ACCOUNT_CREDENTIALS_PATH = Path(".credentials/service_account.json")
 
 is_test_environment = True if os.getenv("TEST") else False
 
-gclient = gspread.service_account(GSPREAD_SERVICE_ACCOUNT_CREDENTIALS_PATH)
-spreadsheet = gclient.open(
-    "OBHonestyData" if not is_test_environment else "Test - OBHonestyData"
+# Google allows 60 read and 60 write requests per minute for each service account
+sheet_rate_limiter = SheetRateLimiter(
+    read_requests_per_minute=float(os.getenv("SHEETS_READ_REQUESTS_PER_MINUTE", 60)),
+    write_requests_per_minute=float(os.getenv("SHEETS_WRITE_REQUESTS_PER_MINUTE", 60)),
 )
-user_sheet = spreadsheet.worksheet("users_2026" if not is_test_environment else "users")
-item_sheet = spreadsheet.worksheet("items")
-order_sheet = spreadsheet.worksheet(
-    "orders_2026" if not is_test_environment else "orders"
+
+
+class SheetRegistry:
+    """Connects to the spreadsheet on first use and caches its worksheets, so importing this module does not need the network.
+    The connection is dropped when its credentials stop working, and the next request connects again.
+    """
+
+    def __init__(self, credentials_path: Path, spreadsheet_name: str):
+        self.credentials_path = credentials_path
+        self.spreadsheet_name = spreadsheet_name
+        self.lock = threading.Lock()
+        self.spreadsheet: Optional[gspread.Spreadsheet] = None
+        self.worksheets: dict[str, gspread.Worksheet] = {}
+
+    def get_spreadsheet(self) -> gspread.Spreadsheet:
+        with self.lock:
+            if self.spreadsheet is None:
+                gclient = gspread.service_account(self.credentials_path)
+                spreadsheet = gclient.open(self.spreadsheet_name)
+                # a single metadata request finds every worksheet, instead of one request per worksheet
+                self.worksheets = {
+                    worksheet.title: worksheet for worksheet in spreadsheet.worksheets()
+                }
+                self.spreadsheet = spreadsheet
+            return self.spreadsheet
+
+    def get_worksheet(self, title: str) -> gspread.Worksheet:
+        self.get_spreadsheet()
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def disconnect(self):
+        with self.lock:
+            self.spreadsheet = None
+            self.worksheets = {}
+
+    def request(self, make_request: Callable):
+        try:
+            return connectivity_breaker.request(make_request)
+        except RefreshError:
+            self.disconnect()
+            raise
+        except gspread.exceptions.APIError as e:
+            if e.code == 401:
+                self.disconnect()
+            raise
+
+
+sheet_registry = SheetRegistry(
+    GSPREAD_SERVICE_ACCOUNT_CREDENTIALS_PATH,
+    "OBHonestyData" if not is_test_environment else "Test - OBHonestyData",
+)
+
+
+class RateLimitedWorksheet:
+    """A worksheet that is looked up when it is first requested, and whose requests are counted against the shared quota at its priority."""
+
+    def __init__(self, title: str, priority: SheetRequestPriority):
+        self.title = title
+        self.priority = priority
+
+    def request(self, kind: str, method_name: str, *args, **kwargs):
+        return sheet_rate_limiter.call(
+            kind,
+            self.priority,
+            sheet_registry.request,
+            lambda: getattr(sheet_registry.get_worksheet(self.title), method_name)(
+                *args, **kwargs
+            ),
+        )
+
+    def get(self, *args, **kwargs):
+        return self.request("read", "get", *args, **kwargs)
+
+    def batch_get(self, *args, **kwargs):
+        return self.request("read", "batch_get", *args, **kwargs)
+
+    def append_rows(self, *args, **kwargs):
+        return self.request("write", "append_rows", *args, **kwargs)
+
+    def update_cells(self, *args, **kwargs):
+        return self.request("write", "update_cells", *args, **kwargs)
+
+
+user_sheet = RateLimitedWorksheet(
+    "users_2026" if not is_test_environment else "users", SheetRequestPriority.DEFAULT
+)
+item_sheet = RateLimitedWorksheet("items", SheetRequestPriority.CATALOG)
+order_sheet = RateLimitedWorksheet(
+    "orders_2026" if not is_test_environment else "orders",
+    SheetRequestPriority.ORDERS,
 )
-admin_sheet = spreadsheet.worksheet(
-    "admin_2026" if not is_test_environment else "admin"
+admin_sheet = RateLimitedWorksheet(
+    "admin_2026" if not is_test_environment else "admin",
+    SheetRequestPriority.CATALOG,
 )
-stripe_payments_sheet = spreadsheet.worksheet("stripe_payments")
-payments_sheet = spreadsheet.worksheet("payments")
-checkouts_sheet = spreadsheet.worksheet("checkouts")
+stripe_payments_sheet = RateLimitedWorksheet(
+    "stripe_payments", SheetRequestPriority.ORDERS
+)
+payments_sheet = RateLimitedWorksheet("payments", SheetRequestPriority.ORDERS)
+checkouts_sheet = RateLimitedWorksheet("checkouts", SheetRequestPriority.ORDERS)
+
+
+def batch_get_sheet_values(
+    planned_ranges: dict[str, list[tuple[RateLimitedWorksheet, Optional[str]]]],
+) -> dict[str, list[list[list]]]:
+    """Reads every planned range in a single request and groups the values by their key.
+    A range of None reads the whole worksheet. The request has the priority of its most urgent sheet.
+    """
+    ranges: list[str] = []
+    range_keys: list[str] = []
+    priority = max(SheetRequestPriority)
+
+    for key, sheet_ranges in planned_ranges.items():
+        for sheet, range_name in sheet_ranges:
+            ranges.append(absolute_range_name(sheet.title, range_name))
+            range_keys.append(key)
+            priority = min(priority, sheet.priority)
+
+    value_ranges = sheet_rate_limiter.call(
+        "read",
+        priority,
+        sheet_registry.request,
+        lambda: sheet_registry.get_spreadsheet().values_batch_get(ranges),
+    ).get("valueRanges", [])
+    sheet_values: dict[str, list[list[list]]] = {key: [] for key in planned_ranges}
+
+    for key, value_range in zip(range_keys, value_ranges):
+        sheet_values[key].append(value_range.get("values", []))
+
+    return sheet_values
@@ -0,0 +1,38 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable, Optional
+
+
+class DebouncedSheetPusher:
+    """Flushes the sheet outbox shortly after rows are committed from any thread.
+    The first commit starts a short debounce window, so a burst of orders is pushed together instead of one call per order.
+    """
+
+    def __init__(self, debounce_seconds: float):
+        self.debounce_seconds = debounce_seconds
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.has_pending: Optional[asyncio.Event] = None
+
+    def notify(self):
+        if self.loop is None:
+            # entries committed before the pusher has started are flushed once it starts
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.has_pending.set)
+        except RuntimeError:
+            # the event loop has closed, the entries stay in the outbox for the next flush
+            pass
+
+    async def run(self, push: Callable[[], None], executor: Executor):
+        self.loop = asyncio.get_running_loop()
+        self.has_pending = asyncio.Event()
+        self.has_pending.set()
+
+        while True:
+            await self.has_pending.wait()
+            await asyncio.sleep(self.debounce_seconds)
+            self.has_pending.clear()
+            try:
+                await self.loop.run_in_executor(executor, push)
+            except Exception as e:
+                print(f"Sheet pusher error: {e}", flush=True)
@@ -0,0 +1,152 @@
+from enum import IntEnum
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable
+import gspread
+
+
+class SheetRequestPriority(IntEnum):
+    # lower values are served first, and higher values leave part of the quota unused for the lower ones
+    ORDERS = 0
+    DEFAULT = 1
+    CATALOG = 2
+
+
+class SheetRateLimitError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: float, burst_fraction: float):
+        # the burst plus a minute of refills must stay within the per-minute quota
+        self.capacity = max(requests_per_minute * burst_fraction, 1)
+        self.refill_per_second = max(requests_per_minute - self.capacity, 1) / 60
+        self.tokens = self.capacity
+        self.updated_timestamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_timestamp) * self.refill_per_second,
+        )
+        self.updated_timestamp = now
+
+    def get_seconds_until(self, tokens: float) -> float:
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.refill_per_second
+
+
+class SheetRateLimiter:
+    """Shares the Sheets API quota between the sync and the write paths, with separate read and write budgets.
+    Waiting requests are served by priority, and lower priority requests cannot use the last of the quota.
+    A quota exceeded response pauses every request for an exponentially growing backoff.
+    """
+
+    def __init__(
+        self,
+        read_requests_per_minute: float,
+        write_requests_per_minute: float,
+        burst_fraction: float = 0.25,
+        reserved_fraction: float = 0.25,
+        max_wait_seconds: float = 15,
+        min_backoff_seconds: float = 2,
+        max_backoff_seconds: float = 64,
+    ):
+        self.buckets = {
+            "read": TokenBucket(read_requests_per_minute, burst_fraction),
+            "write": TokenBucket(write_requests_per_minute, burst_fraction),
+        }
+        self.reserved_fraction = reserved_fraction
+        self.max_wait_seconds = max_wait_seconds
+        self.min_backoff_seconds = min_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.backoff_seconds = 0.0
+        self.backoff_until = 0.0
+        self.condition = threading.Condition()
+        self.waiters: dict[str, list[tuple[int, int]]] = {"read": [], "write": []}
+        self.waiter_numbers = itertools.count()
+
+    def get_reserved_tokens(self, kind: str, priority: SheetRequestPriority) -> float:
+        return (
+            self.buckets[kind].capacity
+            * self.reserved_fraction
+            * priority
+            / max(SheetRequestPriority)
+        )
+
+    def acquire(self, kind: str, priority: SheetRequestPriority):
+        bucket = self.buckets[kind]
+        waiter = (priority, next(self.waiter_numbers))
+        deadline = time.monotonic() + self.max_wait_seconds
+
+        with self.condition:
+            heapq.heappush(self.waiters[kind], waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now < self.backoff_until:
+                        raise SheetRateLimitError(
+                            f"Sheets API quota exceeded, requests are paused for {self.backoff_until - now:.0f}s"
+                        )
+                    bucket.refill(now)
+                    required_tokens = 1 + self.get_reserved_tokens(kind, priority)
+                    if (
+                        self.waiters[kind][0] == waiter
+                        and bucket.tokens >= required_tokens
+                    ):
+                        bucket.tokens -= 1
+                        return
+                    wait_seconds = (
+                        bucket.get_seconds_until(required_tokens)
+                        if self.waiters[kind][0] == waiter
+                        else deadline - now
+                    )
+                    if now + wait_seconds > deadline:
+                        raise SheetRateLimitError(
+                            f"Timed out waiting for the Sheets API {kind} quota"
+                        )
+                    self.condition.wait(max(wait_seconds, 0.01))
+            finally:
+                self.waiters[kind].remove(waiter)
+                heapq.heapify(self.waiters[kind])
+                self.condition.notify_all()
+
+    def record_quota_exceeded(self):
+        with self.condition:
+            self.backoff_seconds = min(
+                max(self.backoff_seconds * 2, self.min_backoff_seconds),
+                self.max_backoff_seconds,
+            )
+            self.backoff_until = time.monotonic() + self.backoff_seconds
+            for bucket in self.buckets.values():
+                bucket.tokens = 0
+            print(
+                f"Sheets API quota exceeded, pausing requests for {self.backoff_seconds:.0f}s",
+                flush=True,
+            )
+
+    def record_success(self):
+        if self.backoff_seconds:
+            with self.condition:
+                self.backoff_seconds = 0
+
+    def call(
+        self,
+        kind: str,
+        priority: SheetRequestPriority,
+        request: Callable,
+        *args,
+        **kwargs,
+    ):
+        self.acquire(kind, priority)
+        try:
+            result = request(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.code == 429:
+                self.record_quota_exceeded()
+            raise
+        self.record_success()
+        return result
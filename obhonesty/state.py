@@ -1,27 +1,36 @@
 from datetime import datetime, timedelta, UTC
 import asyncio
+import time
 from typing import Any, Dict, List, Optional, Literal
-from urllib.parse import quote
 import reflex as rx
 import stripe
-from sqlalchemy import update, select, exists
+from sqlalchemy import select
 from dotenv import load_dotenv
 import os
 from obhonesty.aux import (
+    generate_qr_code_data_uri,
     generate_uuid,
     generate_receiver_from_names,
-    check_internet_connection,
     get_madrid_datetime_now,
+    get_order_time_as_datetime,
     generate_line_item,
     get_system_provider_handling_fee_rounded_to_two_digits,
     get_full_breakfast_item,
 )
+from obhonesty.change_bus import change_bus
+from obhonesty.connectivity import connectivity_breaker
+from obhonesty.shared_cache import shared_table_cache
 from obhonesty.constants import DATETIME_FORMAT
+from obhonesty.stripe_payments import (
+    STRIPE_SESSION_LIFETIME_SECONDS,
+    CachedStripeSession,
+    stripe_session_cache,
+    stripe_session_poller,
+)
 from obhonesty.models import (
     User,
     Order,
     Item,
-    Admin,
     Meal,
     Stripe_Checkout_Session,
     Payment,
@@ -31,7 +40,14 @@ from zoneinfo import ZoneInfo
 
 load_dotenv()
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# the async client keeps a pool of open connections to Stripe, so polling many payment dialogs does not block the event loop or repeat handshakes
+stripe.default_http_client = stripe.HTTPXClient(timeout=20, allow_sync_methods=True)
 is_test_environment = True if os.getenv("TEST") else False
+# pages reload when the change bus reports a change, and also this often in case a change was missed
+CHANGE_BUS_FALLBACK_RELOAD_SECONDS = 60
+ADMIN_PAGE_MEAL_TYPES = {"/admin/breakfast": "breakfast", "/admin/dinner": "dinner"}
+# the meal columns shown in the admin tables, the served state is shown from optimistic_served_states
+ADMIN_MEAL_TABLE_COLUMNS = ["order_time", "receiver", "diet", "allergies", "volunteer"]
 
 
 class State(rx.State):
@@ -110,6 +126,12 @@ class State(rx.State):
     # --- Item Payment State ---
     temp_quantity: float = 1.0
 
+    # --- Cart State ---
+    # item name to quantity, priced from the current items when the cart is ordered
+    cart: dict[str, float] = {}
+    # the orders of the cart's checkout session, written once the session is paid
+    cart_order_requests: list[dict[str, str | float]] = []
+
     # --- Signup button state
     order_request_id: str = ""
     current_order_request_id: str = ""
@@ -136,10 +158,23 @@ class State(rx.State):
 
     @rx.event(background=True)
     async def loop_reload_sheet_data_on_index_page(self):
-        while self.router.page.path == ("/index"):
-            async with self:
-                self.reload_sheet_data()
-            await asyncio.sleep(10)
+        subscription = change_bus.subscribe({"users", "items", "admin"})
+        has_changes = True
+        last_reload_timestamp = 0.0
+        try:
+            while self.router.page.path == ("/index"):
+                # the fallback reload only reads the shared cache, and picks up changes that were not published
+                if (
+                    has_changes
+                    or time.monotonic() - last_reload_timestamp
+                    >= CHANGE_BUS_FALLBACK_RELOAD_SECONDS
+                ):
+                    async with self:
+                        self.reload_sheet_data()
+                    last_reload_timestamp = time.monotonic()
+                has_changes = bool(await subscription.wait(timeout=10))
+        finally:
+            change_bus.unsubscribe(subscription)
 
     @rx.event
     def redirect_to_homepage(self):
@@ -230,20 +265,7 @@ class State(rx.State):
 
     @rx.event
     def expire_stripe_session(self):
-        if not is_test_environment:
-            try:
-                stripe.checkout.Session.expire(self.current_stripe_session_id)
-
-            except Exception as e:
-                # this message means the transaction was successful or has already expired so we should ignore it
-                if (
-                    'Only Checkout Sessions with a status in ["open"] can be expired.'
-                    not in str(e)
-                ):
-                    print(
-                        f"Error expiring Stripe session: {e} - {get_madrid_datetime_now()}",
-                        flush=True,
-                    )
+        stripe_session_cache.release(self.current_stripe_session_id)
 
         self.current_stripe_session_id = ""
 
@@ -280,9 +302,11 @@ class State(rx.State):
             self.optimistic_served_states[meal_id] = value
         try:
             with rx.session() as session:
-                session.exec(
-                    update(Meal).where(Meal.meal_id == meal_id).values(served=value)
-                )
+                # changed through the session, so the meal counts are updated in the same transaction
+                meal = session.exec(
+                    select(Meal).where(Meal.meal_id == meal_id)
+                ).scalar()
+                meal.served = value
                 session.commit()
             async with self:
                 self.update_meal_totals()
@@ -308,6 +332,8 @@ class State(rx.State):
     @rx.event
     def handle_user_reset(self):
         self.current_user = None
+        self.cart = {}
+        self.cart_order_requests = []
 
     @rx.event
     def update_last_user_activity_datetime(self):
@@ -353,37 +379,70 @@ class State(rx.State):
 
     @rx.event
     def get_users_with_active_tabs(self):
-        return rx.session().exec(User.select_users_with_an_active_tab()).scalars().all()
+        return shared_table_cache.get("users_with_active_tabs")
 
     @rx.event
-    def get_todays_breakfast_meals(self):
-        return (
-            rx.session().execute(Meal.select_todays_breakfast_meals()).scalars().all()
-        )
+    def get_todays_meals(
+        self, meal_type: str, meal_ids: Optional[set[str]] = None
+    ) -> List[Meal]:
+        query = Meal.select_todays_meals(meal_type)
+        if meal_ids is not None:
+            query = query.where(Meal.meal_id.in_(meal_ids))
+        return rx.session().execute(query).scalars().all()
 
     @rx.event
-    def get_todays_dinner_meals(self):
-        return rx.session().execute(Meal.select_todays_dinner_meals()).scalars().all()
+    def apply_meal_changes(self, meal_type: str, meal_ids: Optional[set[str]]):
+        """Updates the admin table with only the meals that have changed, and leaves the list untouched when only served states change.
+        A meal_ids of None checks every meal of the type.
+        """
+        list_name = f"todays_{meal_type}_meals"
+        current_meals = {meal.meal_id: meal for meal in getattr(self, list_name)}
+        changed_meals = {
+            meal.meal_id: meal for meal in self.get_todays_meals(meal_type, meal_ids)
+        }
+        has_list_changed = False
+
+        for meal_id in (
+            meal_ids if meal_ids is not None else {*current_meals, *changed_meals}
+        ):
+            meal = changed_meals.get(meal_id)
+            if meal is None:
+                # removed, or no longer one of today's meals of this type
+                if meal_id in current_meals:
+                    del current_meals[meal_id]
+                    has_list_changed = True
+                continue
+            current_meal = current_meals.get(meal_id)
+            if current_meal is None or any(
+                getattr(meal, column) != getattr(current_meal, column)
+                for column in ADMIN_MEAL_TABLE_COLUMNS
+            ):
+                current_meals[meal_id] = meal
+                has_list_changed = True
+            # the table shows the served states from here, so a served toggle only sends this change
+            if self.optimistic_served_states.get(meal_id) != meal.served:
+                self.optimistic_served_states[meal_id] = meal.served
+
+        if has_list_changed:
+            setattr(
+                self,
+                list_name,
+                sorted(
+                    current_meals.values(),
+                    key=lambda meal: (meal.order_time, meal.receiver),
+                ),
+            )
 
     @rx.event
     def get_admin_data(self):
-        admin_data = {}
-        for row in rx.session().exec(Admin.select()).all():
-            if "deadline" in row.key:
-                admin_data[row.key] = row.value
-            elif row.key == "are_payments_enabled":
-                admin_data[row.key] = row.value.lower() == "true"
-                if not self.is_stripe_dialog_active:
-                    self.are_payments_enabled = admin_data[row.key]
-            else:
-                admin_data[row.key] = float(row.value)
+        admin_data = shared_table_cache.get("admin_data")
+        if "are_payments_enabled" in admin_data and not self.is_stripe_dialog_active:
+            self.are_payments_enabled = admin_data["are_payments_enabled"]
         return admin_data
 
     @rx.event
     def get_user(self, nick_name: str) -> User:
-        return (
-            rx.session().exec(select(User).where(User.nick_name == nick_name)).scalar()
-        )
+        return rx.session().exec(User.select_user(nick_name)).scalar()
 
     @rx.event
     def update_current_user(self):
@@ -394,13 +453,7 @@ class State(rx.State):
 
     @rx.event
     def reload_sheet_data(self):
-        with rx.session() as session:
-            items = {}
-            for row in session.exec(Item.select()).all():
-                if row.name == "":
-                    continue
-                items[row.name] = row
-        self.items = items
+        self.items = shared_table_cache.get("items")
         self.users = self.get_users_with_active_tabs()
         self.admin_data = self.get_admin_data()
         self.update_current_user()
@@ -466,22 +519,55 @@ class State(rx.State):
     @rx.event(background=True)
     async def reload_admin_dinner_data(self):
         if self.is_reload_admin_dinner_data_running:
+            # the running loop only notices a page change when it next wakes up, so the new page's meals are loaded here
+            async with self:
+                meal_type = ADMIN_PAGE_MEAL_TYPES.get(self.router.page.path)
+                if meal_type is not None:
+                    self.update_meal_totals()
+                    self.apply_meal_changes(meal_type, None)
             return
         async with self:
             self.is_reload_admin_dinner_data_running = True
-        while self.router.page.path.startswith("/admin"):
-            async with self:
-                self.last_reload_time = get_madrid_datetime_now()
-                self.update_meal_totals()
-                self.users = self.get_users_with_active_tabs()
-                self.todays_breakfast_meals = self.get_todays_breakfast_meals()
-                self.todays_dinner_meals = self.get_todays_dinner_meals()
-                for meal in self.todays_breakfast_meals + self.todays_dinner_meals:
-                    self.optimistic_served_states[meal.meal_id] = meal.served
-                self.admin_data = self.get_admin_data()
-                if self.is_loading_admin_meal_table:
-                    self.is_loading_admin_meal_table = False
-            await asyncio.sleep(3)
+        subscription = change_bus.subscribe({"meals", "users", "admin"})
+        changes = {"meals": None, "users": None, "admin": None}
+        loaded_meal_type: Optional[str] = None
+        last_reload_timestamp = time.monotonic()
+        try:
+            while self.router.page.path.startswith("/admin"):
+                # today's meals also change at midnight, without any commit
+                if (
+                    time.monotonic() - last_reload_timestamp
+                    >= CHANGE_BUS_FALLBACK_RELOAD_SECONDS
+                ):
+                    changes = {"meals": None, "users": None, "admin": None}
+                    last_reload_timestamp = time.monotonic()
+                async with self:
+                    # the screen is up to date as of each wake-up, whether or not anything changed
+                    self.last_reload_time = get_madrid_datetime_now()
+                    # each screen only loads its own meals
+                    meal_type = ADMIN_PAGE_MEAL_TYPES.get(self.router.page.path)
+                    if meal_type is not None and (
+                        "meals" in changes or meal_type != loaded_meal_type
+                    ):
+                        self.update_meal_totals()
+                        self.apply_meal_changes(
+                            meal_type,
+                            (
+                                changes.get("meals")
+                                if meal_type == loaded_meal_type
+                                else None
+                            ),
+                        )
+                        loaded_meal_type = meal_type
+                    if "users" in changes:
+                        self.users = self.get_users_with_active_tabs()
+                    if "admin" in changes:
+                        self.admin_data = self.get_admin_data()
+                    if self.is_loading_admin_meal_table:
+                        self.is_loading_admin_meal_table = False
+                changes = await subscription.wait(timeout=3)
+        finally:
+            change_bus.unsubscribe(subscription)
 
     @rx.event
     def handle_user_login_form_submit(self, form_data):
@@ -491,7 +577,7 @@ class State(rx.State):
         try:
             user = (
                 rx.session()
-                .exec(select(User).where(User.nick_name == form_data["user_nick_name"]))
+                .exec(User.select_user(form_data["user_nick_name"]))
                 .scalar()
             )
 
@@ -543,6 +629,7 @@ class State(rx.State):
             return rx.toast.error("Failed to register. Quantity must be a number")
 
         now = get_madrid_datetime_now()
+        order_time = now.strftime(DATETIME_FORMAT)
 
         with rx.session() as session:
             session.add(
@@ -553,7 +640,8 @@ class State(rx.State):
                         else generate_uuid()
                     ),
                     user_nick_name=self.current_user.nick_name,
-                    time=now.strftime(DATETIME_FORMAT),
+                    time=order_time,
+                    ordered_at=get_order_time_as_datetime(order_time),
                     item=item.name,
                     quantity=quantity,
                     price=item.price,
@@ -600,6 +688,7 @@ class State(rx.State):
                     order_id=generate_uuid(),
                     user_nick_name=self.current_user.nick_name,
                     time=now,
+                    ordered_at=get_order_time_as_datetime(now),
                     item=item_name,
                     quantity=1,
                     price=price,
@@ -622,6 +711,121 @@ class State(rx.State):
             rx.redirect("/user"),
         ]
 
+    @rx.event
+    def add_ordered_item_to_cart(self):
+        self.update_last_user_activity_datetime()
+        if self.temp_quantity <= 0:
+            return rx.toast.error("Failed to add to cart. Quantity must be above zero")
+        self.cart[self.ordered_item] = (
+            self.cart.get(self.ordered_item, 0) + self.temp_quantity
+        )
+        return rx.toast.info(
+            f"'{self.ordered_item}' added to cart.",
+            position="bottom-center",
+        )
+
+    @rx.event
+    def remove_item_from_cart(self, item_name: str):
+        self.update_last_user_activity_datetime()
+        self.cart.pop(item_name, None)
+
+    @rx.var
+    def cart_lines(self) -> list[dict[str, str | float]]:
+        return [
+            {
+                "item": item_name,
+                "quantity": quantity,
+                "total": quantity * self.items[item_name].price,
+            }
+            for item_name, quantity in self.cart.items()
+            if item_name in self.items
+        ]
+
+    @rx.var
+    def cart_total(self) -> float:
+        return sum([cart_line["total"] for cart_line in self.cart_lines])
+
+    @rx.event
+    def get_cart_order_requests(self) -> list[dict[str, str | float]]:
+        return [
+            {
+                "order_id": generate_uuid(),
+                "item": item_name,
+                "quantity": quantity,
+                "price": self.items[item_name].price,
+                "total": quantity * self.items[item_name].price,
+                "receiver": "",
+                "diet": "",
+                "allergies": "",
+                "tax_category": self.items[item_name].tax_category,
+                "comment": "",
+            }
+            for item_name, quantity in self.cart.items()
+            if item_name in self.items
+        ]
+
+    @rx.event
+    def order_cart(self):
+        # a paid cart writes the orders its checkout session was created with, so the order ids match the session
+        order_requests = (
+            self.cart_order_requests
+            if self.is_stripe_session_paid
+            else self.get_cart_order_requests()
+        )
+        if not len(order_requests):
+            return
+
+        now = get_madrid_datetime_now()
+        order_time = now.strftime(DATETIME_FORMAT)
+
+        with rx.session() as session:
+            session.add_all(
+                [
+                    Order(
+                        order_id=order_request["order_id"],
+                        user_nick_name=self.current_user.nick_name,
+                        time=order_time,
+                        ordered_at=get_order_time_as_datetime(order_time),
+                        item=order_request["item"],
+                        quantity=order_request["quantity"],
+                        price=order_request["price"],
+                        total=order_request["total"],
+                        receiver=order_request["receiver"],
+                        diet=order_request["diet"],
+                        allergies=order_request["allergies"],
+                        served="",
+                        tax_category=order_request["tax_category"],
+                        comment=order_request["comment"],
+                    )
+                    for order_request in order_requests
+                ]
+            )
+            if self.is_stripe_session_paid:
+                session.add_all(
+                    [
+                        Payment(
+                            payment_id=generate_uuid(),
+                            order_id=order_request["order_id"],
+                            paid_time=now,
+                            method="stripe-tablet",
+                            checkout_staff="",
+                        )
+                        for order_request in order_requests
+                    ]
+                )
+            # every order and payment is written in a single transaction, so a cart is never partly registered
+            session.commit()
+
+        self.cart = {}
+        self.cart_order_requests = []
+        if self.is_stripe_session_paid:
+            self.is_payment_status_written_to_db = True
+
+        return rx.toast.info(
+            "Cart registered succesfully. Thank you!",
+            position="bottom-center",
+        )
+
     @rx.var(cache=False)
     def get_receiver(self) -> str:
         first_name = (
@@ -638,7 +842,7 @@ class State(rx.State):
 
     @rx.event
     def decrement_prepaid_dinners_quantity(self, session, nick_name: str):
-        user: User = session.query(User).filter(User.nick_name == nick_name).scalar()
+        user: User = session.exec(User.select_user(nick_name)).scalar()
         user.prepaid_dinners_quantity -= 1
         user.is_synced = False
 
@@ -646,6 +850,7 @@ class State(rx.State):
     def order_dinner(self):
         self.has_sheet_data_finished_fetching = False
         now = get_madrid_datetime_now()
+        order_time = now.strftime(DATETIME_FORMAT)
         order_id = self.item_uuid if self.is_stripe_session_paid else generate_uuid()
         dinner_price = (
             self.admin_data.get("dinner_price", 0)
@@ -660,7 +865,8 @@ class State(rx.State):
                 Order(
                     order_id=order_id,
                     user_nick_name=self.current_user.nick_name,
-                    time=now.strftime(DATETIME_FORMAT),
+                    time=order_time,
+                    ordered_at=get_order_time_as_datetime(order_time),
                     item=f"Dinner sign-up{prepaid_dinner_suffix}",
                     quantity=1,
                     price=dinner_price,
@@ -855,6 +1061,7 @@ class State(rx.State):
                     order_id=order_id,
                     user_nick_name=form_data["nick_name"],
                     time=now,
+                    ordered_at=get_order_time_as_datetime(now),
                     item=f"Dinner sign-up{prepaid_dinner_suffix}",
                     quantity=1,
                     price=price,
@@ -901,6 +1108,7 @@ class State(rx.State):
     def order_breakfast(self):
         price = self.get_breakfast_price if not self.current_user.volunteer else 0.0
         now = get_madrid_datetime_now()
+        order_time = now.strftime(DATETIME_FORMAT)
         order_id = order_id = (
             self.item_uuid if self.is_stripe_session_paid else generate_uuid()
         )
@@ -909,7 +1117,8 @@ class State(rx.State):
                 Order(
                     order_id=order_id,
                     user_nick_name=self.current_user.nick_name,
-                    time=now.strftime(DATETIME_FORMAT),
+                    time=order_time,
+                    ordered_at=get_order_time_as_datetime(order_time),
                     item="Breakfast sign-up",
                     quantity=1,
                     price=price,
@@ -990,11 +1199,9 @@ class State(rx.State):
             if not self.is_closing_account:
                 return
 
-            user: User = (
-                session.query(User)
-                .filter(User.nick_name == self.current_user.nick_name)
-                .scalar()
-            )
+            user: User = session.exec(
+                User.select_user(self.current_user.nick_name)
+            ).scalar()
             if not user:
                 return rx.toast.error("Error checking guest out, please see reception.")
             user.has_active_tab = False
@@ -1099,9 +1306,13 @@ class State(rx.State):
             self.payment_qr_code = ""
             self.ob_payment_id = generate_uuid()
 
-        individual_item_request: dict[str, str | float] = {}
+        order_requests: list[dict[str, str | float]] = []
 
-        if item_name != "tab":
+        if item_name == "cart":
+            async with self:
+                self.cart_order_requests = self.get_cart_order_requests()
+            order_requests = self.cart_order_requests
+        elif item_name != "tab":
             async with self:
                 self.item_uuid = generate_uuid()
             is_meal = self.ordered_item in ["breakfast", "dinner"]
@@ -1114,27 +1325,45 @@ class State(rx.State):
             if self.ordered_item == "dinner":
                 item_name = "Dinner sign-up"
                 unit_price = self.admin_data["dinner_price"]
-            individual_item_request = {
-                "order_id": self.item_uuid,
-                "item": item_name,
-                "quantity": quantity,
-                "price": unit_price,
-                "total": quantity * unit_price,
-                "receiver": (self.get_receiver if is_meal else ""),
-                "diet": (self.dinner_signup_dietary_preference if is_meal else ""),
-                "allergies": (self.dinner_signup_allergies if is_meal else ""),
-                "tax_category": (
-                    "Food and beverage non-alcoholic"
-                    if is_meal
-                    else self.items[self.ordered_item].tax_category
-                ),
-                "comment": "",
-            }
+            order_requests = [
+                {
+                    "order_id": self.item_uuid,
+                    "item": item_name,
+                    "quantity": quantity,
+                    "price": unit_price,
+                    "total": quantity * unit_price,
+                    "receiver": (self.get_receiver if is_meal else ""),
+                    "diet": (self.dinner_signup_dietary_preference if is_meal else ""),
+                    "allergies": (self.dinner_signup_allergies if is_meal else ""),
+                    "tax_category": (
+                        "Food and beverage non-alcoholic"
+                        if is_meal
+                        else self.items[self.ordered_item].tax_category
+                    ),
+                    "comment": "",
+                }
+            ]
 
         line_items = (
             self.generate_line_items()
             if item_name == "tab"
-            else [generate_line_item(item_name, int(unit_price * 100), int(quantity))]
+            else [
+                (
+                    generate_line_item(
+                        order_request["item"],
+                        int(order_request["price"] * 100),
+                        int(order_request["quantity"]),
+                    )
+                    if float(order_request["quantity"]).is_integer()
+                    # Stripe only accepts whole quantities, so a fractional quantity is charged as its line total
+                    else generate_line_item(
+                        f"{order_request['item']} x {order_request['quantity']:g}",
+                        round(order_request["total"] * 100),
+                        1,
+                    )
+                )
+                for order_request in order_requests
+            ]
         )
         line_items.append(
             generate_line_item(
@@ -1144,17 +1373,50 @@ class State(rx.State):
             )
         )
 
+        stripe_session_cache_key = stripe_session_cache.get_key(
+            self.current_user.nick_name,
+            line_items,
+            (
+                [{"order_id": order.order_id} for order in self.current_user_orders]
+                if item_name == "tab"
+                else [
+                    {key: value for key, value in order.items() if key != "order_id"}
+                    for order in order_requests
+                ]
+            ),
+        )
+        cached_stripe_session = stripe_session_cache.reuse(stripe_session_cache_key)
+        if cached_stripe_session is not None:
+            # the session's stripe_payments rows have already been written, with its order ids
+            async with self:
+                self.ob_payment_id = cached_stripe_session.ob_payment_id
+                if item_name == "cart":
+                    self.cart_order_requests = cached_stripe_session.order_requests
+                elif item_name != "tab":
+                    self.item_uuid = cached_stripe_session.order_requests[0]["order_id"]
+                self.current_stripe_session_id = cached_stripe_session.stripe_session_id
+                if is_test_environment:
+                    self.payment_qr_code = cached_stripe_session.url
+                    self.test_line_items = line_items
+                else:
+                    self.payment_qr_code = generate_qr_code_data_uri(
+                        cached_stripe_session.url
+                    )
+            return State.check_stripe_payment_status
+
         if is_test_environment:
             datetime_requested = get_madrid_datetime_now().strftime(DATETIME_FORMAT)
+            stripe_session_url = "TEST_URL"
             async with self:
                 self.current_stripe_session_id = f"TEST-STRIPE-ID-{generate_uuid()}"
-                self.payment_qr_code = "TEST_URL"
+                self.payment_qr_code = stripe_session_url
                 self.test_line_items = line_items
         else:
             # 1. Create Stripe Checkout Session
             try:
                 # This creates a payment page hosted by Stripe
-                session = stripe.checkout.Session.create(
+                session = await connectivity_breaker.request_async(
+                    stripe.checkout.Session.create_async,
                     payment_method_types=["card"],
                     line_items=line_items,
                     mode="payment",
@@ -1178,14 +1440,17 @@ class State(rx.State):
                     expires_at=int(
                         (datetime.now(UTC) + timedelta(minutes=30)).timestamp()
                     ),
+                    # Stripe returns the same session if the request is retried after a network error
+                    idempotency_key=f"checkout-session-{self.ob_payment_id}",
                 )
+                stripe_session_url = session.url
                 datetime_requested = datetime.fromtimestamp(
                     session.created, ZoneInfo("Europe/Madrid")
                 ).strftime(DATETIME_FORMAT)
                 async with self:
                     # 2. Generate QR Code pointing to that Stripe URL
                     self.current_stripe_session_id = session.id
-                    self.payment_qr_code = f"https://api.qrserver.com/v1/create-qr-code/?size=250x250&data={quote(session.url)}"
+                    self.payment_qr_code = generate_qr_code_data_uri(session.url)
             except Exception as e:
                 print(f"Stripe Error: {e}", flush=True)
                 async with self:
@@ -1194,11 +1459,19 @@ class State(rx.State):
 
             if self.current_stripe_session_id == "":
                 return
+        stripe_session_cache.add(
+            stripe_session_cache_key,
+            CachedStripeSession(
+                stripe_session_id=self.current_stripe_session_id,
+                url=stripe_session_url,
+                ob_payment_id=self.ob_payment_id,
+                order_requests=order_requests,
+                created_timestamp=time.monotonic(),
+            ),
+        )
         with rx.session() as session:
             for order in (
-                self.current_user_orders
-                if item_name == "tab"
-                else [individual_item_request]
+                self.current_user_orders if item_name == "tab" else order_requests
             ):
                 session.add(
                     Stripe_Checkout_Session(
@@ -1242,69 +1515,55 @@ class State(rx.State):
 
     @rx.event(background=True)
     async def check_stripe_payment_status(self):
-        """Periodically checks if payment was successful"""
-        stripe_error_message = ""
-        # read requests are limited to 500 requests per transaction, see https://docs.stripe.com/rate-limits#api-read-request-allocations
-        stripe_api_get_rate_limit_per_transaction = 500
-        request_count = 0
-
-        while True:
-            if self.current_stripe_session_id == "" or self.is_stripe_session_paid:
-                return
+        """Waits for the Stripe webhook or the server-wide poller to report that the payment was successful"""
+        if self.current_stripe_session_id == "" or self.is_stripe_session_paid:
+            return
 
-            async with self:
-                self.update_last_user_activity_datetime()
+        stripe_session_id = self.current_stripe_session_id
+        payment_status_future = stripe_session_poller.watch(stripe_session_id)
+        watch_deadline = time.monotonic() + STRIPE_SESSION_LIFETIME_SECONDS
 
-            if is_test_environment:
-                if not self.stripe_test_state:
-                    await asyncio.sleep(1)
-                    continue
-            else:
-                request_count += 1
-                result = False
-
-                try:
-                    check_internet_connection()
-                    session = stripe.checkout.Session.retrieve(
-                        self.current_stripe_session_id
-                    )
-                    if session.status == "expired":
-                        async with self:
-                            self.show_stripe_timeout_message = True
+        try:
+            while not payment_status_future.done():
+                async with self:
+                    # the dialog has been closed or a new session has been created
+                    if self.current_stripe_session_id != stripe_session_id:
                         return
-                    result = session.payment_status == "paid"
-                    stripe_error_message = ""
-                    async with self:
-                        self.show_stripe_connection_failure_message = False
-                except Exception as e:
-                    if stripe_error_message != str(e):
-                        stripe_error_message = str(e)
-                        print(
-                            f"Stripe Error: {stripe_error_message} - {get_madrid_datetime_now()}",
-                            flush=True,
-                        )
-                    async with self:
-                        self.show_stripe_connection_failure_message = True
-
-                if not result:
-                    if request_count < stripe_api_get_rate_limit_per_transaction:
-                        # 500 requests spread over 30 minutes is 3.607 secs/request, rounded up to 3.7
-                        await asyncio.sleep(3.7)
-                        continue
-                    async with self:
+                    if time.monotonic() > watch_deadline:
                         self.show_stripe_timeout_message = True
-                    return
+                        return
+                    self.update_last_user_activity_datetime()
+                    self.show_stripe_connection_failure_message = (
+                        stripe_session_poller.has_connection_failed
+                    )
+                    if is_test_environment and self.stripe_test_state:
+                        stripe_session_poller.resolve(stripe_session_id, "paid")
+                        break
+                # wakes up regularly to notice when the dialog is closed, without making any requests
+                await asyncio.wait(
+                    [payment_status_future], timeout=1 if is_test_environment else 3.7
+                )
+        finally:
+            stripe_session_poller.unwatch(stripe_session_id, payment_status_future)
 
+        stripe_session_cache.discard(stripe_session_id)
+        if payment_status_future.result() == "expired":
             async with self:
-                self.is_stripe_session_paid = True
-            if self.ordered_item != "":
-                if self.ordered_item == "dinner":
-                    return State.order_dinner
-                if self.ordered_item == "breakfast":
-                    return State.order_breakfast
-                return State.order_item
-            # if no item has been ordered then it must be the entire tab.
-            return [State.pay_current_tab, State.close_guest_account]
+                self.show_stripe_timeout_message = True
+            return
+
+        async with self:
+            self.is_stripe_session_paid = True
+        if self.ordered_item != "":
+            if self.ordered_item == "dinner":
+                return State.order_dinner
+            if self.ordered_item == "breakfast":
+                return State.order_breakfast
+            if self.ordered_item == "cart":
+                return State.order_cart
+            return State.order_item
+        # if no item has been ordered then it must be the entire tab.
+        return [State.pay_current_tab, State.close_guest_account]
 
     def open_item_dialog(self, item_name: str):
         self.update_last_user_activity_datetime()
@@ -1364,26 +1623,10 @@ class State(rx.State):
 
         orders = (
             rx.session()
-            .query(Order)
-            .filter(
-                Order.user_nick_name == self.current_user.nick_name,
-                ~exists().where(Payment.order_id == Order.order_id),
-            )
+            .exec(Order.select_unpaid_orders(self.current_user.nick_name))
+            .scalars()
             .all()
         )
-
-        for order in orders:
-            order = order.model_dump()
-            try:
-                order.time = datetime.fromisoformat(order.time).strftime(
-                    "%d/%m/%Y, %H:%M:%S"
-                )
-            except BaseException:
-                pass
-
-        orders.sort(
-            key=lambda order: datetime.strptime(order.time, "%d/%m/%Y %H:%M:%S")
-        )
         self.current_user_orders = orders
 
     @rx.var
@@ -0,0 +1,460 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import NamedTuple, Optional
+import reflex as rx
+import stripe
+from sqlalchemy import exists, select
+from obhonesty.aux import (
+    generate_uuid,
+    get_madrid_datetime_now,
+    get_order_time_as_datetime,
+)
+from obhonesty.connectivity import connectivity_breaker
+from obhonesty.constants import DATETIME_FORMAT
+from obhonesty.models import Order, Payment, Stripe_Checkout_Session
+
+is_test_environment = True if os.getenv("TEST") else False
+# checkout sessions expire after 30 minutes, so older sessions never need to be checked
+STRIPE_SESSION_LIFETIME_SECONDS = 31 * 60
+# the e2e tests sign their webhook fixtures with the test secret
+STRIPE_WEBHOOK_SECRET = os.getenv(
+    "STRIPE_WEBHOOK_SECRET", "whsec_test" if is_test_environment else ""
+)
+# a closed payment dialog's session is kept open for this long, so retrying the same purchase reuses it
+STRIPE_SESSION_REUSE_SECONDS = 10 * 60
+STRIPE_WEBHOOK_EVENT_TYPES = {"checkout.session.completed", "checkout.session.expired"}
+
+
+def get_checkout_session_payment_status(session) -> Optional[str]:
+    if session["payment_status"] == "paid":
+        return "paid"
+    if session["status"] == "expired":
+        return "expired"
+    return None
+
+
+class StripeSessionPoller:
+    """Checks every open checkout session on the server with a single list request, instead of one retrieve loop per payment dialog.
+    Each payment dialog waits on a future for its session, which is resolved with "paid" or "expired".
+    When Stripe webhooks are set up they resolve the futures straight away, and polling is only a slow fallback for missed events.
+    """
+
+    def __init__(self, poll_interval_seconds: float):
+        self.poll_interval_seconds = poll_interval_seconds
+        self.waiters: dict[str, set[asyncio.Future]] = {}
+        self.has_waiters: Optional[asyncio.Event] = None
+        self.last_error_message = ""
+
+    @property
+    def has_connection_failed(self) -> bool:
+        return self.last_error_message != ""
+
+    def watch(self, stripe_session_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(stripe_session_id, set()).add(future)
+        if self.has_waiters is not None:
+            self.has_waiters.set()
+        return future
+
+    def unwatch(self, stripe_session_id: str, future: asyncio.Future):
+        futures = self.waiters.get(stripe_session_id)
+        if futures is None:
+            return
+        futures.discard(future)
+        if not len(futures):
+            del self.waiters[stripe_session_id]
+
+    def wake(self):
+        if self.has_waiters is not None:
+            self.has_waiters.set()
+
+    def resolve(self, stripe_session_id: str, payment_status: str):
+        for future in self.waiters.pop(stripe_session_id, set()):
+            if not future.done():
+                future.set_result(payment_status)
+
+    def report(self, stripe_session_id: str, payment_status: str):
+        if stripe_session_id in self.waiters:
+            stripe_session_cache.discard(stripe_session_id)
+            self.resolve(stripe_session_id, payment_status)
+        else:
+            # nobody is waiting on the session of a closed payment dialog, so its payment is recorded here
+            stripe_session_cache.handle_released_session_status(
+                stripe_session_id, payment_status
+            )
+
+    async def handle_webhook_event(self, event: stripe.Event):
+        if event["type"] not in STRIPE_WEBHOOK_EVENT_TYPES:
+            return
+        session = event["data"]["object"]
+        # sessions created outside the app, eg. from the Stripe dashboard, have no ob_payment_id
+        if not session.get("metadata", {}).get("ob_payment_id"):
+            return
+        if not is_test_environment:
+            # the event only says which session to check, so a forged event can never mark a session as paid
+            session = await connectivity_breaker.request_async(
+                stripe.checkout.Session.retrieve_async, session["id"]
+            )
+        payment_status = get_checkout_session_payment_status(session)
+        if payment_status is None:
+            return
+        self.report(session["id"], payment_status)
+
+    async def list_open_period_sessions(self) -> list[stripe.checkout.Session]:
+        sessions: list[stripe.checkout.Session] = []
+        params = {
+            "created": {"gte": int(time.time() - STRIPE_SESSION_LIFETIME_SECONDS)},
+            "limit": 100,
+        }
+        while True:
+            page = await connectivity_breaker.request_async(
+                stripe.checkout.Session.list_async, **params
+            )
+            sessions.extend(page.data)
+            if not page.has_more or not len(page.data):
+                return sessions
+            params["starting_after"] = page.data[-1].id
+
+    async def release_unpaid_sessions(self) -> bool:
+        """Releases the open period's sessions whose stripe_payments rows have no payment, as a restart closes every payment dialog and a late payment would otherwise never be recorded"""
+        try:
+            sessions = await self.list_open_period_sessions()
+            with rx.session() as session:
+                unpaid_session_ids = set(
+                    session.exec(
+                        select(Stripe_Checkout_Session.stripe_payment_id).where(
+                            Stripe_Checkout_Session.stripe_payment_id.in_(
+                                [stripe_session.id for stripe_session in sessions]
+                            ),
+                            ~exists().where(
+                                Payment.order_id == Stripe_Checkout_Session.order_id
+                            ),
+                        )
+                    ).scalars()
+                )
+        except Exception as e:
+            print(f"release_unpaid_sessions error: {e}", flush=True)
+            return False
+
+        for stripe_session in sessions:
+            if (
+                stripe_session.id not in unpaid_session_ids
+                or stripe_session.id in self.waiters
+            ):
+                continue
+            stripe_session_cache.released_session_ids.add(stripe_session.id)
+            # no dialog can reuse the session any more, it is polled until the expiry or a payment made before it is reported
+            if stripe_session.status == "open":
+                stripe_session_expiry_queue.enqueue(stripe_session.id)
+        return True
+
+    async def poll(self):
+        try:
+            sessions = await self.list_open_period_sessions()
+        except Exception as e:
+            if self.last_error_message != str(e):
+                print(f"Stripe Error: {e} - {get_madrid_datetime_now()}", flush=True)
+            self.last_error_message = str(e)
+            return
+        self.last_error_message = ""
+
+        for session in sessions:
+            if (
+                session.id not in self.waiters
+                and session.id not in stripe_session_cache.released_session_ids
+            ):
+                continue
+            payment_status = get_checkout_session_payment_status(session)
+            if payment_status is not None:
+                self.report(session.id, payment_status)
+
+    async def run(self):
+        self.has_waiters = asyncio.Event()
+        has_released_unpaid_sessions = is_test_environment
+        while True:
+            if not has_released_unpaid_sessions:
+                has_released_unpaid_sessions = await self.release_unpaid_sessions()
+            if (
+                has_released_unpaid_sessions
+                and not len(self.waiters)
+                and not len(stripe_session_cache.released_session_ids)
+            ):
+                self.has_waiters.clear()
+                await self.has_waiters.wait()
+            await self.poll()
+            await asyncio.sleep(self.poll_interval_seconds)
+
+
+class StripeSessionExpiryQueue:
+    """Expires checkout sessions in the background, so closing a payment dialog never waits on Stripe.
+    Each session is only queued once, and failed expiries are retried with a backoff. Sessions that still cannot be expired expire by themselves after 30 minutes.
+    """
+
+    def __init__(self, max_attempts: int, retry_seconds: float):
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.attempts: dict[str, int] = {}
+        self.due_timestamps: dict[str, float] = {}
+        self.queue: Optional[asyncio.Queue] = None
+
+    def schedule(self, stripe_session_id: str, delay_seconds: float):
+        self.due_timestamps[stripe_session_id] = time.monotonic() + delay_seconds
+        if self.queue is None:
+            # sessions queued before the queue has started are scheduled once it starts
+            return
+        if delay_seconds > 0:
+            asyncio.get_running_loop().call_later(
+                delay_seconds, self.queue.put_nowait, stripe_session_id
+            )
+        else:
+            self.queue.put_nowait(stripe_session_id)
+
+    def enqueue(self, stripe_session_id: str, delay_seconds: float = 0):
+        if stripe_session_id in self.attempts:
+            return
+        self.attempts[stripe_session_id] = 0
+        self.schedule(stripe_session_id, delay_seconds)
+
+    def cancel(self, stripe_session_id: str):
+        self.attempts.pop(stripe_session_id, None)
+        self.due_timestamps.pop(stripe_session_id, None)
+
+    def is_due(self, stripe_session_id: str) -> bool:
+        # a cancelled session, or one queued again with a later time, is left for its own wake-up
+        return (
+            stripe_session_id in self.attempts
+            and self.due_timestamps[stripe_session_id] - time.monotonic() < 1
+        )
+
+    async def expire(self, stripe_session_id: str) -> bool:
+        try:
+            await connectivity_breaker.request_async(
+                stripe.checkout.Session.expire_async, stripe_session_id
+            )
+        except Exception as e:
+            # this message means the transaction was successful or has already expired so we should ignore it
+            if (
+                'Only Checkout Sessions with a status in ["open"] can be expired.'
+                in str(e)
+            ):
+                return True
+            print(
+                f"Error expiring Stripe session: {e} - {get_madrid_datetime_now()}",
+                flush=True,
+            )
+            return False
+        return True
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        for stripe_session_id, due_timestamp in self.due_timestamps.items():
+            self.schedule(stripe_session_id, due_timestamp - time.monotonic())
+
+        while True:
+            stripe_session_id = await self.queue.get()
+            if not self.is_due(stripe_session_id):
+                continue
+            if await self.expire(stripe_session_id):
+                self.cancel(stripe_session_id)
+                continue
+            self.attempts[stripe_session_id] += 1
+            if self.attempts[stripe_session_id] >= self.max_attempts:
+                self.cancel(stripe_session_id)
+                continue
+            self.schedule(
+                stripe_session_id,
+                self.retry_seconds * 2 ** (self.attempts[stripe_session_id] - 1),
+            )
+
+
+class CachedStripeSession(NamedTuple):
+    stripe_session_id: str
+    url: str
+    ob_payment_id: str
+    # the orders the session's stripe_payments rows were written with
+    order_requests: list[dict]
+    created_timestamp: float
+
+
+class StripeSessionCache:
+    """Keeps the open checkout sessions of recently closed payment dialogs, so tapping the same purchase again reuses its session.
+    A session is matched by the user, a fingerprint of its line items and orders, and its amount. It is expired once it can no longer be reused.
+    A released session can still be paid by a guest who scanned its QR code, so it is polled until it is paid or expired, and a payment is recorded from its stripe_payments rows.
+    The released sessions are only kept in memory, so after a restart they are found again from the stripe_payments rows that have no payment.
+    """
+
+    def __init__(self, reuse_seconds: float):
+        self.reuse_seconds = reuse_seconds
+        self.sessions: dict[tuple[str, str, int], CachedStripeSession] = {}
+        self.in_use_session_ids: set[str] = set()
+        # sessions of closed payment dialogs that have not been paid or expired yet
+        self.released_session_ids: set[str] = set()
+
+    def get_key(
+        self, user_nick_name: str, line_items: list[dict], orders: list[dict]
+    ) -> tuple[str, str, int]:
+        fingerprint = hashlib.sha256(
+            json.dumps(
+                {"line_items": line_items, "orders": orders},
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+        amount = sum(
+            [
+                line_item["price_data"]["unit_amount"] * line_item["quantity"]
+                for line_item in line_items
+            ]
+        )
+        return (user_nick_name, fingerprint, amount)
+
+    def get_seconds_until_stale(self, cached_session: CachedStripeSession) -> float:
+        return cached_session.created_timestamp + self.reuse_seconds - time.monotonic()
+
+    def remove_stale_sessions(self):
+        for key, cached_session in list(self.sessions.items()):
+            if self.get_seconds_until_stale(cached_session) <= 0:
+                del self.sessions[key]
+
+    def add(self, key: tuple[str, str, int], cached_session: CachedStripeSession):
+        self.remove_stale_sessions()
+        self.sessions[key] = cached_session
+        self.in_use_session_ids.add(cached_session.stripe_session_id)
+
+    def reuse(self, key: tuple[str, str, int]) -> Optional[CachedStripeSession]:
+        self.remove_stale_sessions()
+        cached_session = self.sessions.get(key)
+        if (
+            cached_session is None
+            or cached_session.stripe_session_id in self.in_use_session_ids
+        ):
+            return None
+        self.in_use_session_ids.add(cached_session.stripe_session_id)
+        self.released_session_ids.discard(cached_session.stripe_session_id)
+        stripe_session_expiry_queue.cancel(cached_session.stripe_session_id)
+        return cached_session
+
+    def get_by_session_id(
+        self, stripe_session_id: str
+    ) -> Optional[CachedStripeSession]:
+        for cached_session in self.sessions.values():
+            if cached_session.stripe_session_id == stripe_session_id:
+                return cached_session
+        return None
+
+    def release(self, stripe_session_id: str):
+        """Expires the session of a closed payment dialog once it can no longer be reused"""
+        self.in_use_session_ids.discard(stripe_session_id)
+        if is_test_environment:
+            return
+        self.released_session_ids.add(stripe_session_id)
+        stripe_session_poller.wake()
+        cached_session = self.get_by_session_id(stripe_session_id)
+        stripe_session_expiry_queue.enqueue(
+            stripe_session_id,
+            (
+                max(self.get_seconds_until_stale(cached_session), 0)
+                if cached_session is not None
+                else 0
+            ),
+        )
+
+    def discard(self, stripe_session_id: str):
+        """Stops a paid or expired session from being reused"""
+        self.in_use_session_ids.discard(stripe_session_id)
+        self.released_session_ids.discard(stripe_session_id)
+        for key, cached_session in list(self.sessions.items()):
+            if cached_session.stripe_session_id == stripe_session_id:
+                del self.sessions[key]
+
+    def handle_released_session_status(
+        self, stripe_session_id: str, payment_status: str
+    ):
+        if stripe_session_id not in self.released_session_ids:
+            return
+        self.discard(stripe_session_id)
+        stripe_session_expiry_queue.cancel(stripe_session_id)
+        if payment_status == "paid":
+            record_released_session_payment(stripe_session_id)
+
+
+def record_released_session_payment(stripe_session_id: str):
+    """Writes the orders and payments of a session that was paid after its dialog was closed, from the stripe_payments rows written when it was created"""
+    try:
+        with rx.session() as session:
+            stripe_checkout_sessions: list[Stripe_Checkout_Session] = (
+                session.exec(
+                    select(Stripe_Checkout_Session).where(
+                        Stripe_Checkout_Session.stripe_payment_id == stripe_session_id
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            order_ids = [row.order_id for row in stripe_checkout_sessions]
+            # a tab's orders already exist, and a row may have been recorded by an earlier report
+            existing_order_ids = set(
+                session.exec(
+                    select(Order.order_id).where(Order.order_id.in_(order_ids))
+                ).scalars()
+            )
+            paid_order_ids = set(
+                session.exec(
+                    select(Payment.order_id).where(Payment.order_id.in_(order_ids))
+                ).scalars()
+            )
+            now = get_madrid_datetime_now()
+            order_time = now.strftime(DATETIME_FORMAT)
+            for row in stripe_checkout_sessions:
+                if row.order_id not in existing_order_ids:
+                    item, diet = row.item, row.diet
+                    # breakfast sign-ups are sent to Stripe as "Breakfast sign-up (<breakfast item>)"
+                    if item.startswith("Breakfast sign-up ("):
+                        item, diet = "Breakfast sign-up", item[19:-1]
+                    session.add(
+                        Order(
+                            order_id=row.order_id,
+                            user_nick_name=row.user,
+                            time=order_time,
+                            ordered_at=get_order_time_as_datetime(order_time),
+                            item=item,
+                            quantity=row.quantity,
+                            price=row.price,
+                            total=row.total,
+                            receiver=row.receiver,
+                            diet=diet,
+                            allergies=row.allergies,
+                            served="",
+                            tax_category=row.tax_category,
+                            comment=row.comment,
+                        )
+                    )
+                    existing_order_ids.add(row.order_id)
+                if row.order_id not in paid_order_ids:
+                    session.add(
+                        Payment(
+                            payment_id=generate_uuid(),
+                            order_id=row.order_id,
+                            paid_time=now,
+                            method="stripe-tablet",
+                            checkout_staff="",
+                        )
+                    )
+                    paid_order_ids.add(row.order_id)
+            session.commit()
+        print(
+            f"Recorded Stripe session {stripe_session_id} paid after its dialog was closed - {get_madrid_datetime_now()}",
+            flush=True,
+        )
+    except Exception as e:
+        print(f"record_released_session_payment error: {e}", flush=True)
+
+
+stripe_session_poller = StripeSessionPoller(
+    poll_interval_seconds=30 if STRIPE_WEBHOOK_SECRET else 3
+)
+stripe_session_expiry_queue = StripeSessionExpiryQueue(max_attempts=6, retry_seconds=5)
+stripe_session_cache = StripeSessionCache(reuse_seconds=STRIPE_SESSION_REUSE_SECONDS)
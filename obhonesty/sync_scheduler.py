@@ -0,0 +1,103 @@
+from dataclasses import dataclass, field
+import os
+
+
+@dataclass
+class TableSyncSchedule:
+    """How often a table is synced. The interval doubles each time the table is unchanged, up to the max interval,
+    and drops back to the min interval as soon as it changes or has local rows waiting to be synced.
+    """
+
+    table: str
+    min_interval_seconds: float
+    max_interval_seconds: float
+    # lower numbers are synced first
+    priority: int
+    interval_seconds: float = field(init=False)
+    last_sync_timestamp: float = 0
+    next_sync_timestamp: float = 0
+    last_checksum: str = ""
+
+    def __post_init__(self):
+        self.interval_seconds = self.min_interval_seconds
+
+    def record_sync(self, checksum: str, now: float):
+        has_changed = checksum != self.last_checksum
+        self.interval_seconds = (
+            self.min_interval_seconds
+            if has_changed
+            else min(self.interval_seconds * 2, self.max_interval_seconds)
+        )
+        self.last_checksum = checksum
+        self.last_sync_timestamp = now
+        self.next_sync_timestamp = now + self.interval_seconds
+
+    def record_failed_sync(self, now: float):
+        # the last checksum is kept, as the failed sync's changes have not been applied
+        self.interval_seconds = self.min_interval_seconds
+        self.next_sync_timestamp = now + self.interval_seconds
+
+    def expedite(self):
+        self.interval_seconds = self.min_interval_seconds
+        self.next_sync_timestamp = min(
+            self.next_sync_timestamp,
+            self.last_sync_timestamp + self.min_interval_seconds,
+        )
+
+
+def get_table_sync_schedule(
+    table: str,
+    min_interval_seconds: float,
+    max_interval_seconds: float,
+    priority: int,
+) -> TableSyncSchedule:
+    # eg. SYNC_ORDERS_MIN_INTERVAL=5 SYNC_ORDERS_MAX_INTERVAL=30 SYNC_ORDERS_PRIORITY=0
+    env_prefix = f"SYNC_{table.upper()}"
+    return TableSyncSchedule(
+        table=table,
+        min_interval_seconds=float(
+            os.getenv(f"{env_prefix}_MIN_INTERVAL", min_interval_seconds)
+        ),
+        max_interval_seconds=float(
+            os.getenv(f"{env_prefix}_MAX_INTERVAL", max_interval_seconds)
+        ),
+        priority=int(os.getenv(f"{env_prefix}_PRIORITY", priority)),
+    )
+
+
+class SyncScheduler:
+    def __init__(self, schedules: list[TableSyncSchedule]):
+        self.schedules = {schedule.table: schedule for schedule in schedules}
+
+    def get_due_tables(self, now: float) -> list[str]:
+        return [
+            schedule.table
+            for schedule in sorted(
+                self.schedules.values(), key=lambda schedule: schedule.priority
+            )
+            if now >= schedule.next_sync_timestamp
+        ]
+
+    def record_sync(self, table: str, checksum: str, now: float):
+        self.schedules[table].record_sync(checksum, now)
+
+    def record_failed_sync(self, table: str, now: float):
+        self.schedules[table].record_failed_sync(now)
+
+    def expedite(self, table: str):
+        self.schedules[table].expedite()
+
+
+sync_scheduler = SyncScheduler(
+    [
+        # meals are derived locally from the orders and users, so they do not read a sheet
+        get_table_sync_schedule("meals", 30, 30, 0),
+        get_table_sync_schedule("orders", 10, 60, 0),
+        get_table_sync_schedule("payments", 10, 60, 1),
+        get_table_sync_schedule("users", 10, 120, 1),
+        get_table_sync_schedule("stripe_payments", 15, 120, 2),
+        get_table_sync_schedule("checkouts", 15, 120, 2),
+        get_table_sync_schedule("items", 60, 600, 3),
+        get_table_sync_schedule("admin", 60, 600, 3),
+    ]
+)
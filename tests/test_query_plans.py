@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlmodel import Session, SQLModel
+from obhonesty.models import (
+    User,
+    Order,
+    Meal,
+    Stripe_Checkout_Session,
+    SYNCED_MODELS,
+    select_unsynced_rows,
+)
+
+# The app's hot queries must keep using their indexes, eg. a partial index is only used by a query whose condition matches the index's.
+# sqlite uses an index for these queries even when the tables are empty, so no rows are needed.
+
+
+@pytest.fixture(scope="module")
+def session():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def get_query_plan(session: Session, query) -> str:
+    compiled_query = query.compile(
+        dialect=session.get_bind().dialect, compile_kwargs={"literal_binds": True}
+    )
+    return str(session.execute(text(f"EXPLAIN QUERY PLAN {compiled_query}")).all())
+
+
+@pytest.mark.parametrize(
+    "model", SYNCED_MODELS, ids=[model.__tablename__ for model in SYNCED_MODELS]
+)
+def test_unsynced_rows_use_the_unsynced_index(session, model):
+    plan = get_query_plan(session, select_unsynced_rows(model))
+    assert f"USING INDEX ix_{model.__tablename__}_unsynced" in plan
+
+
+@pytest.mark.parametrize(
+    "query, index_names",
+    [
+        (User.select_user("nick"), ["ix_user_nick_name"]),
+        (
+            Order.select_unpaid_orders("nick"),
+            ["ix_order_user_nick_name", "ix_payment_order_id"],
+        ),
+        (Order.select_todays_meal_signups(), ["ix_order_ordered_at"]),
+        (Meal.select_todays_meals(), ["ix_meal_order_time"]),
+        (Meal.select_todays_dinner_meals(), ["ix_meal_order_time"]),
+        (
+            Meal.select_todays_dinner_meals().where(Meal.receiver == "Receiver"),
+            ["ix_meal_receiver"],
+        ),
+        (
+            Stripe_Checkout_Session.select_user_sessions("nick"),
+            ["ix_stripe_checkout_session_user"],
+        ),
+    ],
+    ids=[
+        "user",
+        "unpaid_orders",
+        "todays_meal_signups",
+        "todays_meals",
+        "todays_dinner_meals",
+        "receivers_dinner_meals",
+        "user_stripe_checkout_sessions",
+    ],
+)
+def test_query_uses_its_indexes(session, query, index_names):
+    plan = get_query_plan(session, query)
+    for index_name in index_names:
+        assert f"USING INDEX {index_name}" in plan, plan